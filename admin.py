@@ -0,0 +1,44 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from metrics import SamplingProfiler
+
+
+class AdminHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        admin = self.server.admin
+        if path == '/metrics':
+            self.reply(admin.metrics.registry.render(), 'text/plain; version=0.0.4')
+        elif path == '/profile/start':
+            started = admin.profiler.start()
+            self.reply("Profiler started\n" if started else "Profiler already running\n")
+        elif path == '/profile/stop':
+            report = admin.profiler.stop()
+            self.reply(report if report is not None else "Profiler is not running\n")
+        else:
+            self.send_error(404)
+
+    def reply(self, text, content_type='text/plain'):
+        body = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class AdminServer:
+    """HTTP server on a local port: /metrics, /profile/start and /profile/stop"""
+
+    def __init__(self, metrics, port, host='127.0.0.1'):
+        self.metrics = metrics
+        self.profiler = SamplingProfiler()
+        self.httpd = ThreadingHTTPServer((host, port), AdminHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.admin = self
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
@@ -0,0 +1,110 @@
+"""Compression ratio and CPU cost per message for chat-like traffic.
+
+Compares per-message zlib against the per-connection streams of
+StreamCompression (with and without the preset dictionary) at a fast and
+the default level, on three kinds of traffic: varied chat lines, repetitive
+bot output and the history blocks sent when a user joins a room.
+
+Usage: python benchmarks/compression_bench.py [--count N]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from compression import StreamCompression
+
+WORDS = ("the a to and of is it you that in was for on are with as I his they be at one have this from "
+         "hey lol ok thanks deploy build server client room meeting tomorrow lunch coffee fixed broken "
+         "works merge review please anyone know why what when where ping pong python chat message").split()
+
+
+def chat_lines(rng, count):
+    users = [f"user{i}" for i in range(12)]
+    return [
+        f"[general] {rng.choice(users)}: " + ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 15)))
+        for _ in range(count)
+    ]
+
+
+def bot_lines(rng, count):
+    return [
+        f"[alerts] monitor: build #{4000 + i} {rng.choice(['passed', 'failed'])} on branch "
+        f"{rng.choice(['main', 'develop', 'release'])} in {rng.randint(100, 900)}s, "
+        f"{rng.randint(0, 3)} warnings, coverage {rng.randint(70, 95)}.{rng.randint(0, 9)}%"
+        for i in range(count)
+    ]
+
+
+def history_blocks(rng, count):
+    return [
+        "Last 20 messages in [general]:\n" + '\n'.join(
+            f"  12:{rng.randint(10, 59)} {line.split('] ', 1)[1]}" for line in chat_lines(rng, 20)
+        )
+        for _ in range(count)
+    ]
+
+
+class PerMessage:
+    def __init__(self, level):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level), True
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+def measure(label, make, messages):
+    sender, receiver = make(), make()
+    raw = sum(len(m) for m in messages)
+    sent = 0
+    start = time.perf_counter()
+    wire = []
+    for message in messages:
+        data, compressed = sender.compress(message)
+        wire.append((data, compressed))
+        sent += len(data)
+    compress_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for data, compressed in wire:
+        if compressed:
+            receiver.decompress(data)
+    decompress_time = time.perf_counter() - start
+    print(f"  {label:32} {sent / raw:6.1%} of {raw / len(messages):6.0f} bytes, "
+          f"{compress_time / len(messages) * 1e6:6.1f} us compress, "
+          f"{decompress_time / len(messages) * 1e6:6.1f} us decompress")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=5000)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    corpora = {
+        'chat lines': chat_lines(rng, args.count),
+        'bot output': bot_lines(rng, args.count),
+        'history replay': history_blocks(rng, max(1, args.count // 20)),
+    }
+    modes = [
+        ('per message zlib, level 6', lambda: PerMessage(6)),
+        ('stream, level 1', lambda: StreamCompression(threshold=0, level=1)),
+        ('stream, level 6, no dictionary', lambda: StreamCompression(threshold=0, level=6, dictionary=None)),
+        ('stream, level 6', lambda: StreamCompression(threshold=0, level=6)),
+        ('stream, level 6, threshold 32', lambda: StreamCompression(threshold=32, level=6)),
+    ]
+    for name, lines in corpora.items():
+        messages = [line.encode('utf-8') for line in lines]
+        print(f"{name}:")
+        for label, make in modes:
+            measure(label, make, messages)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Messages/sec on one core for per-message Cipher construction vs CryptoSession.
+
+Usage: python benchmarks/crypto_bench.py [--count N] [--sizes 64,256,1024]
+"""
+import argparse
+import os
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.backends import default_backend
+from crypto_session import CryptoSession
+from framing import MESSAGE
+
+# CFB is deprecated in recent cryptography releases, it is only used here as the baseline
+warnings.simplefilter('ignore')
+
+
+def per_message_cipher(session_key, iv, messages):
+    """What encrypt_message used to do: a new CFB encryptor for every message"""
+    for message in messages:
+        encryptor = Cipher(
+            algorithms.AES(session_key),
+            modes.CFB(iv),
+            backend=default_backend()
+        ).encryptor()
+        encryptor.update(message) + encryptor.finalize()
+
+
+def persistent_session(session_key, iv, messages):
+    session = CryptoSession(session_key, iv, is_server=True)
+    for message in messages:
+        session.encrypt(message, MESSAGE)
+
+
+def measure(func, session_key, iv, messages):
+    start = time.perf_counter()
+    func(session_key, iv, messages)
+    return len(messages) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Encryption hot path microbenchmark")
+    parser.add_argument('--count', type=int, default=200000, help='Messages per run')
+    parser.add_argument('--sizes', default='64,256,1024', help='Comma separated message sizes in bytes')
+    args = parser.parse_args()
+
+    session_key = os.urandom(32)
+    iv = os.urandom(16)
+
+    print(f"{'size':>6} {'per-message Cipher':>20} {'CryptoSession':>16} {'speedup':>8}")
+    for size in [int(s) for s in args.sizes.split(',')]:
+        messages = [os.urandom(size) for _ in range(args.count)]
+        before = measure(per_message_cipher, session_key, iv, messages)
+        after = measure(persistent_session, session_key, iv, messages)
+        print(f"{size:>6} {before:>16,.0f} msg/s {after:>10,.0f} msg/s {after / before:>7.1f}x")
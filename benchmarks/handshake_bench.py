@@ -0,0 +1,69 @@
+"""Server side handshakes/sec for each --handshake-pool mode.
+
+Wraps a batch of session secrets the way clients do and unwraps them all at
+once through an inline loop, a thread pool and a process pool, like a burst
+of clients reconnecting after a restart.
+
+Usage: python benchmarks/handshake_bench.py [--count N] [--workers N]
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.backends import default_backend
+from server import init_handshake_worker, decrypt_session_secret
+
+
+def wrap_secrets(public_key, count):
+    return [
+        public_key.encrypt(
+            os.urandom(48),
+            padding.OAEP(
+                mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                algorithm=hashes.SHA256(),
+                label=None
+            )
+        )
+        for _ in range(count)
+    ]
+
+
+def measure(label, run, count):
+    start = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - start
+    print(f"{label:>8}: {count / elapsed:>8,.0f} handshakes/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Handshake RSA offload benchmark")
+    parser.add_argument('--count', type=int, default=2000, help='Handshakes per run')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Pool size')
+    args = parser.parse_args()
+
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    private_key_pem = private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()
+    )
+    secrets = wrap_secrets(private_key.public_key(), args.count)
+    print(f"{args.count} handshakes, {args.workers} workers")
+
+    measure('none', lambda: [decrypt_session_secret(s, private_key) for s in secrets], args.count)
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        measure('thread', lambda: list(pool.map(decrypt_session_secret, secrets, [private_key] * len(secrets))),
+                args.count)
+
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_handshake_worker,
+                             initargs=(private_key_pem,)) as pool:
+        # Warm up the workers so process start-up isn't part of the measurement
+        list(pool.map(decrypt_session_secret, secrets[:args.workers]))
+        measure('process', lambda: list(pool.map(decrypt_session_secret, secrets, chunksize=16)), args.count)
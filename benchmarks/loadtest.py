@@ -0,0 +1,347 @@
+"""Headless load test: simulated users against a chat server, results as JSON.
+
+Starts server.py on a free port (or targets a running server with --port),
+connects --users simulated users through ChatConnection with a shared RSA
+key pair, puts them in rooms of --room-size and has each send --rate
+messages per second for --duration seconds. Every message carries its send
+time, so each delivery to a room member gives one fan-out latency sample.
+
+Reports connect rate, sent and delivered messages/sec, p50/p90/p99/max
+fan-out latency and server RSS as JSON. All users run in this one process,
+with a single thread receiving for all of them; when that thread is busy
+the latencies include its backlog, so keep an eye on the harness CPU too.
+
+Usage: python benchmarks/loadtest.py [--users N] [--room-size N] [--rate MSGS_PER_SEC]
+                                     [--duration SECONDS] [--server-args "--engine asyncio"]
+                                     [--output results.json]
+"""
+import argparse
+import json
+import os
+import selectors
+import shlex
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.backends import default_backend
+from client import ChatConnection
+from framing import MESSAGE, JOIN, PART
+from server import DEFAULT_ROOM
+
+# Marks load test messages, followed by the send time
+MARKER = ' lt '
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, server_args):
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'server.py'), '--port', str(port), '--stats-interval', '0']
+        + shlex.split(server_args),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("Server did not start listening")
+
+
+def rss_kb(pid):
+    """Resident memory of a process and its direct children (cluster workers), None if unknown"""
+    if pid is None:
+        return None
+    total = 0
+    try:
+        pids = [pid] + [int(p) for p in os.listdir('/proc') if p.isdigit() and parent_pid(int(p)) == pid]
+        for p in pids:
+            with open(f'/proc/{p}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+    except OSError:
+        return None
+    return total
+
+
+def parent_pid(pid):
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            return int(f.read().rsplit(')', 1)[1].split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def raise_file_limit():
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class LoadTest:
+    def __init__(self, args, port):
+        self.args = args
+        self.port = port
+        self.users = []
+        self.room_sizes = {}
+        self.connect_failures = 0
+        self.sent = 0
+        self.expected = 0
+        self.delivered = 0
+        self.latencies = []
+        self.lock = threading.Lock()
+        self.selector = selectors.DefaultSelector()
+        self.receiving = True
+        self.last_receive = time.monotonic()
+
+    def room_of(self, i):
+        if self.args.room_size >= self.args.users:
+            return DEFAULT_ROOM
+        return f"load{i // self.args.room_size}"
+
+    def connect_user(self, i, private_key):
+        user = ChatConnection(f"load{i}", self.args.host, self.port, private_key=private_key,
+                              compression=not self.args.no_compression)
+        try:
+            user.connect(self.args.connect_timeout)
+            room = self.room_of(i)
+            if room != DEFAULT_ROOM:
+                user.send(JOIN, room)
+                user.send(PART, DEFAULT_ROOM)
+        except Exception:
+            with self.lock:
+                self.connect_failures += 1
+            return None
+        user.room = room
+        return user
+
+    def connect_all(self):
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.args.connect_concurrency) as pool:
+            results = list(pool.map(lambda i: self.connect_user(i, private_key), range(self.args.users)))
+        elapsed = time.perf_counter() - start
+
+        self.users = [user for user in results if user]
+        for user in self.users:
+            self.room_sizes[user.room] = self.room_sizes.get(user.room, 0) + 1
+            self.selector.register(user.socket, selectors.EVENT_READ, user)
+            # Frames that arrived with the handshake are already in the decoder
+            self.process_frames(user, time.perf_counter())
+        return elapsed
+
+    def process_frames(self, user, now):
+        while True:
+            frame = user.decoder.next_frame()
+            if frame is None:
+                try:
+                    user.send_ack()
+                except OSError:
+                    pass
+                return
+            message = user.process_frame(*frame)
+            if message is None:
+                continue
+            index = message.find(MARKER)
+            if index < 0:
+                continue
+            sent_at = float(message[index + len(MARKER):].split(' ', 1)[0])
+            with self.lock:
+                self.delivered += 1
+                self.latencies.append(now - sent_at)
+
+    def receive_loop(self):
+        while self.receiving:
+            for key, _ in self.selector.select(timeout=0.1):
+                user = key.data
+                try:
+                    nbytes = user.socket.recv_into(user.decoder.get_buffer())
+                except OSError:
+                    nbytes = 0
+                if not nbytes:
+                    self.selector.unregister(user.socket)
+                    continue
+                user.decoder.buffer_updated(nbytes)
+                self.process_frames(user, time.perf_counter())
+                self.last_receive = time.monotonic()
+
+    def send_loop(self):
+        """Open loop sender: messages go out on schedule whether or not earlier ones were delivered"""
+        interval = 1 / (self.args.rate * len(self.users))
+        padding = 'x' * max(0, self.args.message_size - 20)
+        start = time.perf_counter()
+        end = start + self.args.duration
+        k = 0
+        while True:
+            target = start + k * interval
+            if target >= end:
+                break
+            delay = target - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            user = self.users[k % len(self.users)]
+            k += 1
+            try:
+                user.send(MESSAGE, f"{MARKER.strip()} {time.perf_counter():.6f} {padding}")
+            except OSError:
+                continue
+            with self.lock:
+                self.sent += 1
+                self.expected += self.room_sizes[user.room]
+        return time.perf_counter() - start
+
+    def run(self, server_pid):
+        rss_before = rss_kb(server_pid)
+        connect_seconds = self.connect_all()
+        if not self.users:
+            raise RuntimeError("No simulated user could connect")
+        rss_connected = rss_kb(server_pid)
+
+        receiver = threading.Thread(target=self.receive_loop, daemon=True)
+        receiver.start()
+        # Let the join and part notices (and group key rotations) settle before measuring
+        deadline = time.monotonic() + 60
+        while time.monotonic() - self.last_receive < self.args.settle and time.monotonic() < deadline:
+            time.sleep(0.05)
+        with self.lock:
+            self.latencies.clear()
+            self.delivered = 0
+
+        send_seconds = self.send_loop()
+        rss_loaded = rss_kb(server_pid)
+        deadline = time.monotonic() + self.args.drain
+        while time.monotonic() < deadline and self.delivered < self.expected:
+            time.sleep(0.05)
+        receive_seconds = send_seconds + self.args.drain - max(0, deadline - time.monotonic())
+        self.receiving = False
+        receiver.join()
+
+        latencies = sorted(self.latencies)
+        to_ms = lambda value: None if value is None else round(value * 1000, 3)
+        return {
+            'revision': git_revision(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'config': {
+                'users': self.args.users,
+                'room_size': self.args.room_size,
+                'rooms': len(self.room_sizes),
+                'rate_per_user': self.args.rate,
+                'duration': self.args.duration,
+                'message_size': self.args.message_size,
+                'compression': not self.args.no_compression,
+                'server_args': self.args.server_args,
+            },
+            'connect': {
+                'connected': len(self.users),
+                'failed': self.connect_failures,
+                'seconds': round(connect_seconds, 3),
+                'per_second': round(len(self.users) / connect_seconds, 1),
+            },
+            'messages': {
+                'sent': self.sent,
+                'sent_per_second': round(self.sent / send_seconds, 1),
+                'expected_deliveries': self.expected,
+                'delivered': self.delivered,
+                'delivered_per_second': round(self.delivered / receive_seconds, 1),
+            },
+            'latency_ms': {
+                'p50': to_ms(percentile(latencies, 0.5)),
+                'p90': to_ms(percentile(latencies, 0.9)),
+                'p99': to_ms(percentile(latencies, 0.99)),
+                'max': to_ms(latencies[-1] if latencies else None),
+            },
+            'server_rss_kb': {
+                'idle': rss_before,
+                'connected': rss_connected,
+                'loaded': rss_loaded,
+            },
+        }
+
+    def close(self):
+        for user in self.users:
+            user.socket.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--room-size', type=int, default=20, help='Users per room')
+    parser.add_argument('--rate', type=float, default=1, help='Messages per second sent by each user (the server drops what exceeds its --rate-limit)')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds of sending')
+    parser.add_argument('--message-size', type=int, default=100, help='Approximate message length')
+    # More concurrent connects than the server's --backlog overflow it and stall
+    # in SYN retransmits
+    parser.add_argument('--no-compression', action='store_true',
+                        help='Simulated users decline the compression the server offers')
+    parser.add_argument('--connect-concurrency', type=int, default=4, help='Handshakes in flight at once')
+    parser.add_argument('--connect-timeout', type=float, default=10, help='Seconds before a handshake counts as failed')
+    parser.add_argument('--settle', type=float, default=1,
+                        help='Quiet seconds to wait for after connecting before sending starts')
+    parser.add_argument('--drain', type=float, default=5, help='Seconds to wait for deliveries after sending')
+    parser.add_argument('--server-args', default='', help='Extra arguments for the server this script starts')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=None, help='Use a server that is already running')
+    parser.add_argument('--server-pid', type=int, default=None, help='PID of that server, for RSS')
+    parser.add_argument('--output', default=None, help='Also write the JSON results to this file')
+    args = parser.parse_args()
+
+    raise_file_limit()
+    server = None
+    port, server_pid = args.port, args.server_pid
+    if port is None:
+        port = free_port()
+        server = start_server(port, args.server_args)
+        server_pid = server.pid
+
+    test = LoadTest(args, port)
+    try:
+        results = test.run(server_pid)
+    finally:
+        test.close()
+        if server:
+            server.terminate()
+            server.wait()
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == "__main__":
+    main()
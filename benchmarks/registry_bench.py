@@ -0,0 +1,276 @@
+"""Broadcast throughput while users keep joining and leaving the room.
+
+Fills a room of a ChatServer (no sockets, outboxes that discard what they
+get) with --members users, then has --senders threads broadcast to it as
+fast as they can while --churn threads make other users join and leave the
+same room. Each configuration runs twice: 'locked' holds the server lock
+around every broadcast, the way the message path used to, and 'snapshot'
+broadcasts from the copy-on-write member snapshot without it.
+
+With --check the outboxes check what they get instead, the churn threads
+disconnect and reconnect their users (keeping mailboxes) and the script
+verifies what the lock-free path has to guarantee: no user is
+sent a group message before the key it is encrypted with, and every
+broadcast reaches every churning user, in their outbox or their mailbox,
+exactly once. It also replays the two interleavings that race most
+closely, a user reconnecting or dropping right after a broadcast read the
+room, and checks the broadcast still reaches them. It exits with status 1
+if any of this fails.
+
+Usage: python benchmarks/registry_bench.py [--members N] [--senders N] [--churn N]
+                                           [--duration SECONDS] [--group-key] [--check]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.backends import default_backend
+from framing import HEADER, GROUP_KEY, GROUP_MESSAGE
+from logger import default_logger
+from offline import Sequenced
+from server import ChatServer, ClientRecord, Room, DEFAULT_ROOM
+
+# Room keys a client keeps per room, as in ChatConnection.set_group_key
+KEPT_KEYS = 3
+
+
+class NullOutbox:
+    """Accepts everything, so the benchmark measures the fan-out and not the writers"""
+    queued_bytes = 0
+
+    def put(self, data):
+        return True
+
+    def close(self):
+        pass
+
+
+class CheckingOutbox(NullOutbox):
+    """Checks the group frames it gets in the order it gets them, refuses puts once closed like a real outbox.
+
+    kept is the user's room name -> epochs of the keys it has, oldest first,
+    shared by the user's connections since the client keeps its keys across
+    reconnects. errors counts group messages whose key the user does not have.
+    """
+
+    def __init__(self, kept):
+        self.kept = kept
+        self.errors = 0
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def put(self, data):
+        frame = data.message if isinstance(data, Sequenced) else data
+        with self.lock:
+            if self.closed:
+                return False
+            if isinstance(frame, bytes):
+                self.check(frame)
+            return True
+
+    def check(self, frame):
+        epoch = int.from_bytes(frame[HEADER.size:HEADER.size + 4], byteorder='big')
+        if frame[4] == GROUP_KEY:
+            name_end = HEADER.size + 5 + frame[HEADER.size + 4]
+            epochs = self.kept.setdefault(frame[HEADER.size + 5:name_end], [])
+            epochs.append(epoch)
+            del epochs[:-KEPT_KEYS]
+        elif frame[4] == GROUP_MESSAGE and not any(epoch in epochs for epochs in self.kept.values()):
+            self.errors += 1
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+
+
+def add_user(server, username, public_key, outbox):
+    client = ClientRecord(None, public_key)
+    client.username = username
+    client.outbox = outbox
+    with server.lock:
+        server.add_client(client)
+    return client
+
+
+def connect_user(server, username, public_key, outboxes):
+    """Register a user the way a client handler does, with a mailbox and a fresh checking outbox"""
+    outbox = CheckingOutbox(outboxes[-1].kept if outboxes else {})
+    outboxes.append(outbox)
+    client = add_user(server, username, public_key, outbox)
+    with server.lock:
+        server.open_mailbox(client)
+    return client
+
+
+def disconnect_user(server, client):
+    """What a client handler does when its connection drops"""
+    with server.lock:
+        server.remove_client(client.username)
+        server.leave_all_rooms(client.username, keep=True)
+    client.outbox.close()
+
+
+class HookedRoom(Room):
+    """A Room that runs a one-shot hook right after a broadcast reads its snapshot"""
+
+    @property
+    def snapshot(self):
+        value = self.__dict__['snapshot']
+        hook = self.__dict__.pop('hook', None)
+        if hook:
+            hook()
+        return value
+
+    @snapshot.setter
+    def snapshot(self, value):
+        self.__dict__['snapshot'] = value
+
+
+def check_interleavings(private_key, args):
+    """Reconnect, then drop, a user in the middle of a broadcast; True when both times it reaches them"""
+    server = ChatServer(port=0, stats_interval=0, handshake_pool='none', rate_limit=0,
+                        offline_hold=3600, offline_max_messages=10 ** 9,
+                        group_key=args.group_key, private_key=private_key)
+    public_key = private_key.public_key()
+    outboxes = []
+    connect_user(server, "sender", public_key, [])
+    client = connect_user(server, "user", public_key, outboxes)
+    disconnect_user(server, client)
+    clients = [client]
+
+    def reconnect():
+        clients.append(connect_user(server, "user", public_key, outboxes))
+
+    def drop():
+        disconnect_user(server, clients[-1])
+
+    missed = []
+    for name, hook in (('reconnecting', reconnect), ('dropping', drop)):
+        room = server.rooms[DEFAULT_ROOM]
+        room.__class__ = HookedRoom
+        room.hook = hook
+        message = f"message sent while {name}"
+        server.broadcast(message, DEFAULT_ROOM, sender="sender")
+        if not any(held.endswith(message) for _, held in server.mailboxes["user"].pending):
+            missed.append(name)
+    server.server_socket.close()
+    default_logger.flush()
+    print(f"  interleavings: {', '.join(missed) + ' missed' if missed else 'ok'}")
+    return not missed
+
+
+def measure(private_key, args, mode, churners):
+    server = ChatServer(port=0, stats_interval=0, handshake_pool='none', rate_limit=0,
+                        offline_hold=3600 if args.check else 0, offline_max_messages=10 ** 9,
+                        group_key=args.group_key, private_key=private_key)
+    public_key = private_key.public_key()
+    outboxes = []  # every CheckingOutbox, with --check
+    for i in range(args.members):
+        outbox = CheckingOutbox({}) if args.check else NullOutbox()
+        outboxes.append(outbox)
+        add_user(server, f"member{i}", public_key, outbox)
+        with server.lock:
+            server.join_room(f"member{i}", DEFAULT_ROOM, replay=False)
+    churn_clients = []
+    churn_outboxes = [[] for _ in range(churners)]
+    for i in range(churners):
+        if args.check:
+            churn_clients.append(connect_user(server, f"churn{i}", public_key, churn_outboxes[i]))
+        else:
+            churn_clients.append(add_user(server, f"churn{i}", public_key, NullOutbox()))
+
+    stop = threading.Event()
+    broadcasts = [0] * args.senders
+    churn_ops = [0] * churners
+
+    def send(index):
+        while not stop.is_set():
+            message = f"message {broadcasts[index]} from sender {index} " + 'x' * 60
+            if mode == 'locked':
+                with server.lock:
+                    server.broadcast(message, DEFAULT_ROOM, sender=f"member{index}")
+            else:
+                server.broadcast(message, DEFAULT_ROOM, sender=f"member{index}")
+            broadcasts[index] += 1
+
+    def churn(index):
+        username = f"churn{index}"
+        client = churn_clients[index]
+        while not stop.is_set():
+            if args.check:
+                disconnect_user(server, client)
+                client = connect_user(server, username, public_key, churn_outboxes[index])
+            else:
+                with server.lock:
+                    server.join_room(username, DEFAULT_ROOM, replay=False)
+                with server.lock:
+                    server.leave_room(username, DEFAULT_ROOM)
+            churn_ops[index] += 2
+
+    threads = [threading.Thread(target=send, args=(i,)) for i in range(args.senders)]
+    threads += [threading.Thread(target=churn, args=(i,)) for i in range(churners)]
+    queued_before = server.metrics.messages_out.value
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    queued = server.metrics.messages_out.value - queued_before
+    server.server_socket.close()
+    default_logger.flush()
+
+    print(f"  {mode:8} {churners:2} churn threads: {sum(broadcasts) / elapsed:9.0f} broadcasts/sec, "
+          f"{queued / elapsed:10.0f} deliveries/sec, {sum(churn_ops) / elapsed:8.0f} joins+leaves/sec")
+    if not args.check:
+        return True
+
+    errors = sum(outbox.errors for outbox in outboxes + sum(churn_outboxes, []))
+    missing = duplicated = 0
+    for i in range(churners):
+        # Nothing is acked, so the mailbox still has every message the user was sent or held
+        got = Counter(message for _, message in server.mailboxes[f"churn{i}"].pending
+                      if message.startswith(f"[{DEFAULT_ROOM}] member"))
+        duplicated += sum(count - 1 for count in got.values())
+        for index, count in enumerate(broadcasts):
+            for n in range(count):
+                if f"[{DEFAULT_ROOM}] member{index}: message {n} from sender {index} " + 'x' * 60 not in got:
+                    missing += 1
+    print(f"           check: {errors} messages before their key, {missing} broadcasts missed, "
+          f"{duplicated} delivered twice")
+    return not (errors or missing or duplicated)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--members', type=int, default=200)
+    parser.add_argument('--senders', type=int, default=4)
+    parser.add_argument('--churn', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=3)
+    parser.add_argument('--group-key', action='store_true',
+                        help='Encrypt broadcasts with the room key, every join and leave rotates it')
+    parser.add_argument('--check', action='store_true',
+                        help='Record and verify what every user is sent, churn by reconnecting (slower)')
+    args = parser.parse_args()
+
+    # Every broadcast is logged, keep that off the terminal
+    default_logger.stream = open(os.devnull, 'w')
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    print(f"{args.members} members, {args.senders} sender threads, {args.duration:g} s per run")
+    ok = check_interleavings(private_key, args) if args.check else True
+    for churners in (0, args.churn):
+        for mode in ('locked', 'snapshot'):
+            ok = measure(private_key, args, mode, churners) and ok
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
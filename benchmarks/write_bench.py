@@ -0,0 +1,82 @@
+"""Socket writes per message for a client outbox under a broadcast burst.
+
+Queues a burst of chat messages on a ClientOutbox connected to a local
+socket pair, in small groups like broadcasts arriving from many senders,
+and counts the sendmsg calls the writer needs for each --flush-delay value.
+
+Usage: python benchmarks/write_bench.py [--count N] [--size BYTES]
+"""
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import ClientOutbox
+
+
+class CountingSocket:
+    """Socket wrapper counting the write system calls"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.writes = 0
+
+    def sendmsg(self, buffers):
+        self.writes += 1
+        return self.sock.sendmsg(buffers)
+
+    def shutdown(self, how):
+        self.sock.shutdown(how)
+
+
+def drain(sock, total):
+    received = 0
+    while received < total:
+        data = sock.recv(1024 * 1024)
+        if not data:
+            break
+        received += len(data)
+
+
+def measure(flush_delay, count, size):
+    server_side, client_side = socket.socketpair()
+    counting = CountingSocket(server_side)
+    outbox = ClientOutbox(counting, max_bytes=64 * 1024 * 1024, flush_delay=flush_delay)
+    outbox.start()
+    reader = threading.Thread(target=drain, args=(client_side, count * size))
+    reader.start()
+
+    message = b'x' * size
+    start = time.perf_counter()
+    for i in range(count):
+        outbox.put(message)
+        if i % 10 == 9:
+            # Give the writer a chance to run between groups of broadcasts
+            time.sleep(0)
+    reader.join()
+    elapsed = time.perf_counter() - start
+
+    outbox.close()
+    server_side.close()
+    client_side.close()
+    print(f"flush delay {flush_delay * 1000:4.1f} ms: {counting.writes:6} writes, "
+          f"{count / counting.writes:7.1f} messages per write, {count / elapsed:10.0f} messages/sec")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=20000)
+    parser.add_argument('--size', type=int, default=120)
+    args = parser.parse_args()
+
+    print(f"{args.count} messages of {args.size} bytes, one write per message before batching")
+    for flush_delay in (0, 0.001, 0.005):
+        measure(flush_delay, args.count, args.size)
+
+
+if __name__ == "__main__":
+    main()
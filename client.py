@@ -1,35 +1,55 @@
+import argparse
+import asyncio
 import socket
 import threading
 import cmd
 import sys
 import os
-import base64
+import itertools
+from collections import deque
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
-import os
-
-
-class ChatClient(cmd.Cmd):
-    prompt = '> '
-    intro = "Welcome to the Encrypted Python Chat Room! Type 'help' for a list of commands."
-
-    def __init__(self):
-        super().__init__()
-        self.host = None
-        self.port = 8000
+from compression import StreamCompression
+from crypto_session import CryptoSession, derive_resumed_secret
+from transfer import IncomingFile
+from framing import (FrameDecoder, encode_frame, expect_frame, read_frame, read_frame_async,
+                     send_buffers_async, COMPRESSED, SEQUENCED, SEQUENCE,
+                     PUBLIC_KEY, SESSION_KEY, USERNAME, MESSAGE, GROUP_KEY, GROUP_MESSAGE,
+                     RESUME, RESUME_OK, RESUME_FAILED, TICKET, JOIN, PART, LIST_ROOMS, DIRECT, HISTORY,
+                     PING, PONG, ACK, FILE_OFFER, FILE_CHUNK, FILE_END, FILE_CREDIT,
+                     FILE_HEADER, FILE_ID, FILE_CREDIT_GRANT, FILE_DONE, FILE_CANCELLED, FILE_CHUNK_SIZE)
+
+# Most bytes of files a connection saves in total, offers beyond it are skipped
+DOWNLOAD_LIMIT = 200 * 1024 * 1024
+
+
+class ChatConnection:
+    """Protocol side of the chat client: handshake, session encryption and frames.
+
+    It does no terminal I/O, so besides ChatClient it also drives the
+    simulated users of benchmarks/loadtest.py. Pass a private_key to share
+    one RSA key pair between many connections instead of generating one each.
+    With compression set, messages are compressed when the server offers it.
+    Files sent to our rooms are saved in download_dir, or skipped without one,
+    up to download_limit bytes in all.
+    """
+
+    def __init__(self, username=None, host=None, port=8000, private_key=None, compression=True,
+                 download_dir=None, download_limit=DOWNLOAD_LIMIT):
+        self.host = host
+        self.port = port
         self.socket = None
+        self.decoder = None
         self.connected = False
-        self.username = None
+        # The receiving side answers pings while another thread may be sending
+        self.send_lock = threading.Lock()
+        self.username = username
 
-        # Generate client's key pair
-        self.private_key = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=2048,
-            backend=default_backend()
-        )
-        self.public_key = self.private_key.public_key()
+        # Client's key pair, generated on the first full handshake
+        self.private_key = private_key
+        self.public_key = private_key.public_key() if private_key else None
 
         # Server's public key (will be obtained during connection)
         self.server_public_key = None
@@ -37,44 +57,549 @@ class ChatClient(cmd.Cmd):
         # Session key for AES encryption (will be generated during connection)
         self.session_key = None
         self.iv = None
-
-    def encrypt_message(self, message):
-        # Use AES for message encryption
-        encryptor = Cipher(
-            algorithms.AES(self.session_key),
-            modes.CFB(self.iv),
-            backend=default_backend()
-        ).encryptor()
-
-        encrypted_data = encryptor.update(message.encode('utf-8')) + encryptor.finalize()
-        return base64.b64encode(encrypted_data).decode('utf-8')
-
-    def decrypt_message(self, encrypted_message):
-        # Decrypt using AES
-        encrypted_data = base64.b64decode(encrypted_message.encode('utf-8'))
+        self.session = None
+
+        # Deflate streams for this connection, when both sides want compression
+        self.use_compression = compression
+        self.compression = None
+
+        # Room keys sent by a server running in group key mode, epoch -> (room, key)
+        self.group_keys = {}
+
+        # Files arriving from the server, by the id the server gave the transfer
+        self.download_dir = download_dir
+        self.download_budget = download_limit  # what is left, offers reserve their size
+        self.incoming = {}
+
+        # Sequence numbers of the server-side mailbox, kept across reconnects so
+        # messages the server sends again after a drop are only shown once
+        self.mailbox_id = None
+        self.last_seq = 0
+        self.acked_seq = 0
+
+        # Session resumption ticket from the last connection, lets /reconnect skip RSA
+        self.ticket = None
+        self.resumption_secret = None
+        # Set when the server turned our ticket down and connect() fell back to RSA
+        self.ticket_rejected = False
+
+    def encrypt_message(self, frame_type, message, flags=0):
+        # Next nonce of our outgoing counter, no per-message key setup
+        return self.session.encrypt(message.encode('utf-8'), frame_type, flags)
+
+    def decrypt_message(self, encrypted_message, flags=0, sequence=b''):
+        data = self.session.decrypt(encrypted_message, MESSAGE, flags, sequence)
+        if flags & COMPRESSED:
+            if self.compression is None:
+                raise ConnectionError("Compressed message without negotiated compression")
+            data = self.compression.decompress(data)
+        return data.decode('utf-8')
+
+    def set_group_key(self, payload):
+        # GROUP_KEY payload is epoch + room name length + room name + room key wrapped with our public key
+        epoch = int.from_bytes(payload[:4], byteorder='big')
+        name_end = 5 + payload[4]
+        room_name = bytes(payload[5:name_end]).decode('utf-8')
+        key = self.private_key.decrypt(
+            bytes(payload[name_end:]),
+            padding.OAEP(
+                mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                algorithm=hashes.SHA256(),
+                label=None
+            )
+        )
+        self.group_keys[epoch] = (room_name, key)
+        # Keep a couple of older keys per room for messages already in flight during a rotation
+        room_epochs = sorted(e for e, (room, _) in self.group_keys.items() if room == room_name)
+        for old_epoch in room_epochs[:-3]:
+            del self.group_keys[old_epoch]
+
+    def decrypt_group_message(self, payload):
+        # GROUP_MESSAGE payload is epoch + nonce + AES-CTR ciphertext
+        epoch = int.from_bytes(payload[:4], byteorder='big')
+        if epoch not in self.group_keys:
+            # Queued before more rotations than we keep keys for
+            return "(Skipped a message sent with an expired room key.)"
         decryptor = Cipher(
-            algorithms.AES(self.session_key),
-            modes.CFB(self.iv),
+            algorithms.AES(self.group_keys[epoch][1]),
+            modes.CTR(bytes(payload[4:20])),
             backend=default_backend()
         ).decryptor()
 
-        decrypted_data = decryptor.update(encrypted_data) + decryptor.finalize()
+        decrypted_data = decryptor.update(payload[20:]) + decryptor.finalize()
         return decrypted_data.decode('utf-8')
 
-    def default(self, line):
-        """Handle direct messages without requiring the 'say' command"""
-        if self.connected and line:
-            try:
-                # Encrypt the message before sending
-                encrypted_message = self.encrypt_message(line)
-                self.socket.send(encrypted_message.encode('utf-8'))
-            except Exception as e:
-                print(f"Failed to send message: {e}")
+    def connect(self, timeout=None):
+        """Open the connection and run the handshake, returns True if the session was resumed.
+
+        timeout limits each blocking step of the handshake, not the connection afterwards.
+        """
+        if self.socket:
+            self.socket.close()
+        self.connected = False
+        # Transfers do not survive the connection
+        for incoming in self.incoming.values():
+            self.finish_file(incoming, FILE_CANCELLED)
+        self.incoming = {}
+        self.socket = socket.create_connection((self.host, self.port), timeout)
+        # Every write is a complete set of frames, waiting for more data only adds latency
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        # STEP 1: Receive server's public key
+        self.decoder = FrameDecoder()
+        frame = read_frame(self.socket, self.decoder)
+        server_public_key_pem = expect_frame(frame, PUBLIC_KEY)
+        # The server offers compression with a flag on its key, both streams start fresh on every connection
+        offered = frame[1] & COMPRESSED
+        self.compression = StreamCompression() if offered and self.use_compression else None
+
+        self.ticket_rejected = False
+        resumed = self.ticket is not None and self.resume()
+        handshake_frames = b'' if resumed else self.full_handshake(server_public_key_pem)
+
+        # STEP 4: Send encrypted username, in the same write as the handshake frames,
+        # flagged if we take the compression offer
+        flags = COMPRESSED if self.compression else 0
+        encrypted_username = self.encrypt_message(USERNAME, self.username, flags)
+        self.socket.sendall(handshake_frames + encode_frame(USERNAME, encrypted_username, flags))
+
+        self.socket.settimeout(None)
+        self.connected = True
+        return resumed
+
+    def resume(self):
+        """Present our ticket instead of the RSA key exchange, returns False if the server rejects it"""
+        client_nonce = os.urandom(16)
+        self.socket.sendall(encode_frame(RESUME, client_nonce + self.ticket))
+
+        frame = read_frame(self.socket, self.decoder)
+        if frame is not None and frame[0] == RESUME_FAILED:
+            self.ticket_rejected = True
+            self.ticket = None
+            self.resumption_secret = None
+            return False
+        server_nonce = expect_frame(frame, RESUME_OK)
+
+        self.session_key, self.iv = derive_resumed_secret(self.resumption_secret, client_nonce, server_nonce)
+        self.session = CryptoSession(self.session_key, self.iv, is_server=False)
+        return True
+
+    def full_handshake(self, server_public_key_pem):
+        """Set up the session, returns the PUBLIC_KEY and SESSION_KEY frames for the caller to send"""
+        # Load the server's public key
+        try:
+            self.server_public_key = serialization.load_pem_public_key(
+                server_public_key_pem,
+                backend=default_backend()
+            )
+        except Exception as e:
+            raise ConnectionError(f"Failed to load the server's public key: {e}") from e
+
+        # Generate client's key pair once, reconnects reuse it
+        if self.private_key is None:
+            self.private_key = rsa.generate_private_key(
+                public_exponent=65537,
+                key_size=2048,
+                backend=default_backend()
+            )
+            self.public_key = self.private_key.public_key()
+
+        # STEP 2: Client's public key for the server
+        public_key_pem = self.public_key.public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+
+        # STEP 3: Generate the session key and encrypt it with server's public key
+        self.session_key = os.urandom(32)  # 256-bit key for AES
+        self.iv = os.urandom(16)  # Initialization vector
+
+        # Encrypt session key and IV together with server's public key, so the
+        # server needs a single RSA decrypt per connection
+        encrypted_session_key = self.server_public_key.encrypt(
+            self.session_key + self.iv,
+            padding.OAEP(
+                mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                algorithm=hashes.SHA256(),
+                label=None
+            )
+        )
+
+        self.session = CryptoSession(self.session_key, self.iv, is_server=False)
+        return encode_frame(PUBLIC_KEY, public_key_pem) + encode_frame(SESSION_KEY, encrypted_session_key)
+
+    def write(self, data):
+        """Put complete frames on the wire"""
+        self.socket.sendall(data)
+
+    def send(self, frame_type, text):
+        """Compress (if negotiated) and encrypt text with the session and send it as one frame"""
+        self.send_data(frame_type, text.encode('utf-8'))
+
+    def send_data(self, frame_type, data, compress=True):
+        with self.send_lock:
+            flags = 0
+            if compress and self.compression:
+                data, compressed = self.compression.compress(data)
+                flags = COMPRESSED if compressed else 0
+            self.write(encode_frame(frame_type, self.session.encrypt(data, frame_type, flags), flags))
+
+    def accept_sequence(self, payload):
+        """Track the sequence number in front of payload, False if we have seen the message already"""
+        mailbox_id, seq = SEQUENCE.unpack_from(payload)
+        if mailbox_id != self.mailbox_id:
+            # A new mailbox on the server, its numbers start over
+            self.mailbox_id = mailbox_id
+            self.last_seq = self.acked_seq = 0
+        if seq <= self.last_seq:
+            return False
+        self.last_seq = seq
+        return True
+
+    def send_ack(self):
+        """Tell the server which messages arrived, so it can stop keeping them.
+        Call when the frames received so far have been processed."""
+        if self.last_seq > self.acked_seq and self.connected:
+            with self.send_lock:
+                self.write(encode_frame(ACK, SEQUENCE.pack(self.mailbox_id, self.last_seq)))
+            self.acked_seq = self.last_seq
+
+    def process_frame(self, frame_type, flags, payload):
+        """Handle one frame from the server, returns the chat text it carries or None"""
+        is_new = True
+        sequence = b''
+        if flags & SEQUENCED:
+            is_new = self.accept_sequence(payload)
+            sequence, payload = payload[:SEQUENCE.size], payload[SEQUENCE.size:]
+        if frame_type == TICKET:
+            # Resumption secret followed by the opaque ticket
+            ticket_data = self.session.decrypt(payload, TICKET, flags)
+            self.resumption_secret, self.ticket = ticket_data[:32], ticket_data[32:]
+        elif frame_type == GROUP_KEY:
+            self.set_group_key(payload)
+        elif frame_type == GROUP_MESSAGE:
+            return self.decrypt_group_message(payload) if is_new else None
+        elif frame_type == MESSAGE:
+            # Decrypted even when it is a repeat, to keep the session stream in step
+            message = self.decrypt_message(payload, flags, sequence)
+            return message if is_new else None
+        elif frame_type in (FILE_OFFER, FILE_CHUNK, FILE_END):
+            return self.receive_file_frame(frame_type, self.session.decrypt(payload, frame_type, flags))
+        elif frame_type == PING:
+            with self.send_lock:
+                self.write(encode_frame(PONG, b''))
+        return None
+
+    def receive_file_frame(self, frame_type, data):
+        """Write a file arriving from the server to disk, returns the notice to show or None"""
+        if frame_type == FILE_OFFER:
+            relay_id, size = FILE_HEADER.unpack_from(data)
+            room_name, sender, name = data[FILE_HEADER.size:].decode('utf-8').split('\n', 2)
+            if self.download_dir and size > self.download_budget:
+                incoming = IncomingFile(None, room_name, sender, name, size, 'not saved, over the download limit')
+            else:
+                incoming = IncomingFile(self.download_dir, room_name, sender, name, size)
+            if incoming.file:
+                self.download_budget -= size
+            self.incoming[relay_id] = incoming
+            return incoming.describe()
+        incoming = self.incoming.get(FILE_ID.unpack_from(data)[0])
+        if incoming is None:
+            return None
+        if frame_type == FILE_CHUNK:
+            incoming.write(data[FILE_ID.size:])
+            return None
+        del self.incoming[FILE_ID.unpack_from(data)[0]]
+        return self.finish_file(incoming, data[FILE_ID.size])
+
+    def finish_file(self, incoming, status):
+        notice = incoming.finish(status)
+        if incoming.file and not incoming.complete:
+            # The discarded file gives its reservation back
+            self.download_budget += incoming.size
+        return notice
+
+    def receive(self):
+        """Block until the next chat message arrives, None once the server closed the connection"""
+        while True:
+            frame = self.decoder.next_frame()
+            if frame is None:
+                self.send_ack()
+                frame = read_frame(self.socket, self.decoder)
+            if frame is None:
                 self.connected = False
-        elif not self.connected:
+                return None
+            message = self.process_frame(*frame)
+            if message is not None:
+                return message
+
+
+class AsyncChatConnection(ChatConnection):
+    """ChatConnection with its network I/O on an asyncio event loop, for bots and the terminal UI.
+
+    open() runs the blocking handshake (RSA included) in the loop's executor,
+    then a reader task decodes frames and a writer task sends what send()
+    queued, all frames that piled up in one write. Chat messages wait in a
+    bounded inbox; when the consumer falls behind the oldest are dropped and
+    counted in dropped instead of slowing down the connection. A frame from
+    the server it cannot handle closes the connection, the exception is left
+    in error.
+
+    send() only encrypts and queues, so it never blocks and may be called
+    from any thread. send_file() streams a file to the room as the server
+    grants credit for it. Read messages with receive_batch() or messages():
+
+        bot = AsyncChatConnection('bot', 'localhost', 8000)
+        await bot.open()
+        async for message in bot.messages():
+            bot.send(MESSAGE, f"you said: {message}")
+    """
+
+    def __init__(self, username=None, host=None, port=8000, private_key=None, compression=True,
+                 inbox_size=1000, download_dir=None, download_limit=DOWNLOAD_LIMIT):
+        super().__init__(username, host, port, private_key, compression, download_dir, download_limit)
+        self.loop = None
+        self.inbox = deque(maxlen=inbox_size)
+        self.dropped = 0
+        self.inbox_ready = None
+        self.outgoing = []
+        self.outgoing_ready = None
+        self.tasks = []
+        self.transfer_ids = itertools.count(1)
+        self.file_grants = {}  # transfer id -> asyncio.Queue of the chunk counts the server grants
+        self.error = None  # the exception a bad frame from the server closed the connection with
+
+    async def open(self, timeout=None):
+        """Connect and start the I/O tasks, returns True if the session was resumed"""
+        self.cancel_tasks()
+        self.loop = asyncio.get_running_loop()
+        self.inbox.clear()
+        self.inbox_ready = asyncio.Event()
+        self.outgoing = []
+        self.outgoing_ready = asyncio.Event()
+        self.error = None
+        resumed = await self.loop.run_in_executor(None, self.connect, timeout)
+        self.socket.setblocking(False)
+        self.tasks = [self.loop.create_task(self.read_loop()), self.loop.create_task(self.write_loop())]
+        return resumed
+
+    def write(self, data):
+        if not self.connected:
+            raise ConnectionError("Not connected")
+        self.loop.call_soon_threadsafe(self.queue_frame, data)
+
+    def queue_frame(self, data):
+        self.outgoing.append(data)
+        self.outgoing_ready.set()
+
+    async def write_loop(self):
+        try:
+            while self.connected:
+                await self.outgoing_ready.wait()
+                self.outgoing_ready.clear()
+                buffers, self.outgoing = self.outgoing, []
+                await send_buffers_async(self.loop, self.socket, buffers)
+        except OSError:
+            self.disconnected()
+
+    async def read_loop(self):
+        try:
+            while True:
+                frame = self.decoder.next_frame()
+                if frame is None:
+                    # Everything received so far is processed, one ack covers it
+                    self.send_ack()
+                    frame = await read_frame_async(self.loop, self.socket, self.decoder)
+                if frame is None:
+                    break
+                message = self.process_frame(*frame)
+                if message is not None:
+                    if len(self.inbox) == self.inbox.maxlen:
+                        self.dropped += 1
+                    self.inbox.append(message)
+                    self.inbox_ready.set()
+        except (OSError, ConnectionError):
+            pass
+        except Exception as e:
+            # A frame we cannot handle leaves the session streams out of step, the connection is unusable
+            self.error = e
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        finally:
+            self.disconnected()
+
+    def process_frame(self, frame_type, flags, payload):
+        if frame_type == FILE_CREDIT:
+            transfer_id, chunks = FILE_CREDIT_GRANT.unpack(payload)
+            if transfer_id in self.file_grants:
+                self.file_grants[transfer_id].put_nowait(chunks)
+            return None
+        return super().process_frame(frame_type, flags, payload)
+
+    async def send_file(self, path):
+        """Send a file to the room we talk in, returns True once all of it is sent.
+
+        Chunks are read and encrypted one at a time, only when the server has
+        granted credit for them, so memory use does not grow with the file
+        and chat messages sent meanwhile wait behind a few chunks at most.
+        Returns False if the server refused or stopped the transfer.
+        """
+        transfer_id = next(self.transfer_ids) % (1 << 32)
+        grants = self.file_grants[transfer_id] = asyncio.Queue()
+        try:
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                name = os.path.basename(path).encode('utf-8')
+                self.send_data(FILE_OFFER, FILE_HEADER.pack(transfer_id, size) + name, compress=False)
+                sent = credit = 0
+                while sent < size:
+                    while not credit:
+                        grant = await grants.get()
+                        if not grant:
+                            return False
+                        credit += grant
+                    chunk = f.read(min(FILE_CHUNK_SIZE, size - sent))
+                    if not chunk:
+                        break  # the file got shorter
+                    self.send_data(FILE_CHUNK, FILE_ID.pack(transfer_id) + chunk, compress=False)
+                    sent += len(chunk)
+                    credit -= 1
+                status = FILE_DONE if sent == size else FILE_CANCELLED
+                self.send_data(FILE_END, FILE_ID.pack(transfer_id) + bytes([status]), compress=False)
+                return status == FILE_DONE
+        finally:
+            del self.file_grants[transfer_id]
+
+    def disconnected(self):
+        self.connected = False
+        self.inbox_ready.set()
+        self.outgoing_ready.set()
+        self.stop_transfers()
+
+    def stop_transfers(self):
+        """Make the send_file calls in progress return, as if the server had stopped them"""
+        for grants in self.file_grants.values():
+            grants.put_nowait(0)
+
+    async def receive_batch(self):
+        """Wait for chat messages and return all that are waiting, None once the connection is closed"""
+        while not self.inbox:
+            if not self.connected:
+                return None
+            await self.inbox_ready.wait()
+            self.inbox_ready.clear()
+        batch = list(self.inbox)
+        self.inbox.clear()
+        return batch
+
+    async def messages(self):
+        """Async iterator over the chat messages, ends when the connection closes"""
+        while True:
+            batch = await self.receive_batch()
+            if batch is None:
+                return
+            for message in batch:
+                yield message
+
+    def cancel_tasks(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    async def close(self):
+        self.connected = False
+        self.cancel_tasks()
+        self.stop_transfers()
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+
+
+class ChatClient(AsyncChatConnection, cmd.Cmd):
+    """Terminal client: input on the main thread, network and screen updates on an event loop thread.
+
+    Incoming messages are drawn in batches, at most redraw_rate times per
+    second, so a busy room costs one terminal write per batch instead of one
+    per message.
+    """
+    prompt = '> '
+    intro = "Welcome to the Encrypted Python Chat Room! Type 'help' for a list of commands."
+
+    def __init__(self, redraw_rate=10, inbox_size=1000, download_dir=None, download_limit=DOWNLOAD_LIMIT):
+        AsyncChatConnection.__init__(self, inbox_size=inbox_size, download_dir=download_dir,
+                                     download_limit=download_limit)
+        cmd.Cmd.__init__(self)
+        self.redraw_interval = 1 / redraw_rate
+        self.renderer = None
+        self.io_loop = asyncio.new_event_loop()
+        threading.Thread(target=self.io_loop.run_forever, daemon=True).start()
+
+    def send_frame(self, frame_type, text):
+        """Encrypt text with the session and send it as one frame"""
+        if not self.connected:
             print("You are not connected. Use '/connect username server_address' first.")
+            return
+        try:
+            self.send(frame_type, text)
+        except Exception as e:
+            print(f"Failed to send message: {e}")
+            self.connected = False
+
+    def default(self, line):
+        """Handle direct messages without requiring the 'say' command"""
+        if line or not self.connected:
+            self.send_frame(MESSAGE, line)
         return False
 
+    def do_join(self, arg):
+        """Join a room, creating it if needed, and send your messages there: /join room_name"""
+        if not arg.strip():
+            print("Usage: /join room_name")
+            return
+        self.send_frame(JOIN, arg.strip())
+
+    def do_leave(self, arg):
+        """Leave a room, the one you are talking in if none is given: /leave [room_name]"""
+        self.send_frame(PART, arg.strip())
+
+    def do_rooms(self, arg):
+        """List the rooms on the server"""
+        self.send_frame(LIST_ROOMS, '')
+
+    def do_history(self, arg):
+        """Show earlier messages of the room you are talking in: /history [count | minutes followed by m]"""
+        self.send_frame(HISTORY, arg.strip())
+
+    def do_msg(self, arg):
+        """Send a private message to one user: /msg username message"""
+        recipient, _, text = arg.strip().partition(' ')
+        if not recipient or not text.strip():
+            print("Usage: /msg username message")
+            return
+        self.send_frame(DIRECT, f"{recipient}\n{text.strip()}")
+
+    def do_send(self, arg):
+        """Send a file to everyone in the room you are talking in: /send path"""
+        path = os.path.expanduser(arg.strip())
+        if not path:
+            print("Usage: /send path")
+            return
+        if not os.path.isfile(path):
+            print(f"No such file: {path}")
+            return
+        if not self.connected:
+            print("You are not connected. Use '/connect username server_address' first.")
+            return
+        # Runs on the event loop, the server reports progress as chat messages
+        future = asyncio.run_coroutine_threadsafe(self.send_file(path), self.io_loop)
+        future.add_done_callback(self.file_sent)
+
+    def file_sent(self, future):
+        if future.exception():
+            print(f"\nFailed to send file: {future.exception()}")
+
     def do_connect(self, arg):
         if self.connected:
             print("You are already connected!")
@@ -104,81 +629,34 @@ class ChatClient(cmd.Cmd):
             self.host = server_address
             self.port = 8000  # Default port
 
-        try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            print(f"Attempting to connect to {self.host}:{self.port}...")
-            self.socket.connect((self.host, self.port))
-
-            # STEP 1: Receive server's public key using proper framing
-            key_size_bytes = self.socket.recv(4)
-            key_size = int.from_bytes(key_size_bytes, byteorder='big')
-            server_public_key_pem = b''
-            remaining = key_size
-            while remaining > 0:
-                chunk = self.socket.recv(min(remaining, 4096))
-                if not chunk:
-                    raise ConnectionError("Connection closed during key exchange")
-                server_public_key_pem += chunk
-                remaining -= len(chunk)
-
-            # Load the server's public key
-            try:
-                self.server_public_key = serialization.load_pem_public_key(
-                    server_public_key_pem,
-                    backend=default_backend()
-                )
-            except Exception as e:
-                print(f"Failed to load server's public key: {e}")
-                print(f"Received data: {server_public_key_pem[:100]}...")
-                raise
-
-            # STEP 2: Send client's public key to server with proper framing
-            public_key_pem = self.public_key.public_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PublicFormat.SubjectPublicKeyInfo
-            )
-            self.socket.send(len(public_key_pem).to_bytes(4, byteorder='big'))
-            self.socket.send(public_key_pem)
-
-            # STEP 3: Generate and send session key encrypted with server's public key
-            self.session_key = os.urandom(32)  # 256-bit key for AES
-            self.iv = os.urandom(16)  # Initialization vector
-
-            # Encrypt the session key with server's public key
-            encrypted_session_key = self.server_public_key.encrypt(
-                self.session_key,
-                padding.OAEP(
-                    mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                    algorithm=hashes.SHA256(),
-                    label=None
-                )
-            )
+        # A ticket from another server or for another username is of no use
+        self.ticket = None
+        self.resumption_secret = None
+        self.establish()
 
-            # Encrypt the IV with server's public key
-            encrypted_iv = self.server_public_key.encrypt(
-                self.iv,
-                padding.OAEP(
-                    mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                    algorithm=hashes.SHA256(),
-                    label=None
-                )
-            )
-
-            # Send encrypted session key and IV with proper framing
-            self.socket.send(len(encrypted_session_key).to_bytes(4, byteorder='big'))
-            self.socket.send(encrypted_session_key)
-            self.socket.send(len(encrypted_iv).to_bytes(4, byteorder='big'))
-            self.socket.send(encrypted_iv)
-
-            # STEP 4: Send encrypted username
-            encrypted_username = self.encrypt_message(self.username)
-            username_data = encrypted_username.encode('utf-8')
-            self.socket.send(len(username_data).to_bytes(4, byteorder='big'))
-            self.socket.send(username_data)
+    def do_reconnect(self, arg):
+        """Reconnect to the last server, resuming the session without RSA when a ticket is available"""
+        if self.connected:
+            print("You are already connected!")
+            return
+        if not self.host or not self.username:
+            print("Nothing to reconnect to. Use '/connect username server_address' first.")
+            return
+        self.establish()
 
-            self.connected = True
-            threading.Thread(target=self.receive_messages, daemon=True).start()
-            print(f"Securely connected to the server as {self.username}")
+    def establish(self):
+        try:
+            print(f"Attempting to connect to {self.host}:{self.port}...")
+            resumed = asyncio.run_coroutine_threadsafe(self.open(), self.io_loop).result()
+            if self.renderer:
+                self.renderer.cancel()
+            self.renderer = asyncio.run_coroutine_threadsafe(self.render(), self.io_loop)
+            if resumed:
+                print(f"Securely reconnected to the server as {self.username} (session resumed)")
+            else:
+                if self.ticket_rejected:
+                    print("Session ticket rejected, did a full handshake.")
+                print(f"Securely connected to the server as {self.username}")
 
         except Exception as e:
             print(f"Failed to connect: {e}")
@@ -186,24 +664,22 @@ class ChatClient(cmd.Cmd):
                 self.socket.close()
                 self.socket = None
 
-    # Remaining methods similar to original, but with encryption/decryption
-
-    def receive_messages(self):
-        while self.connected:
-            try:
-                encrypted_message = self.socket.recv(2048).decode('utf-8')
-                if not encrypted_message:
-                    print("Disconnected from server.")
-                    self.connected = False
-                    break
-
-                # Decrypt the message
-                message = self.decrypt_message(encrypted_message)
-                print(f"\n{message}\n{self.prompt}", end='')
-            except Exception as e:
-                print(f"\nLost connection to server: {e}")
-                self.connected = False
-                break
+    async def render(self):
+        """Draw incoming messages, everything that arrived since the last redraw in a single write"""
+        while True:
+            batch = await self.receive_batch()
+            if batch is None:
+                if self.error:
+                    print(f"\nClosed the connection after a bad frame from the server: {self.error!r}")
+                print("\nDisconnected from server.")
+                return
+            if self.dropped:
+                batch.insert(0, f"({self.dropped} messages skipped, the terminal could not keep up)")
+                self.dropped = 0
+            sys.stdout.write('\n' + '\n'.join(batch) + f'\n{self.prompt}')
+            sys.stdout.flush()
+            # Messages arriving meanwhile are drawn together with the next batch
+            await asyncio.sleep(self.redraw_interval)
 
     # Override to make all commands start with '/'
     def get_names(self):
@@ -234,7 +710,19 @@ class ChatClient(cmd.Cmd):
 
 
 if __name__ == "__main__":
-    client = ChatClient()
+    parser = argparse.ArgumentParser(description="Encrypted chat client")
+    parser.add_argument('--redraw-rate', type=float, default=10,
+                        help='Most screen updates per second when messages arrive in bursts')
+    parser.add_argument('--inbox-size', type=int, default=1000,
+                        help='Messages kept waiting for the screen before the oldest are skipped')
+    parser.add_argument('--download-dir',
+                        help='Save the files other users send to your rooms in this directory, off by default')
+    parser.add_argument('--download-limit', type=float, default=DOWNLOAD_LIMIT / (1024 * 1024),
+                        help='Most MB of files saved in one run, larger offers are skipped')
+    args = parser.parse_args()
+
+    client = ChatClient(args.redraw_rate, args.inbox_size, args.download_dir,
+                        int(args.download_limit * 1024 * 1024))
     try:
         client.cmdloop()
     except KeyboardInterrupt:
@@ -0,0 +1,221 @@
+import itertools
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+from concurrent.futures import Future
+from framing import FrameDecoder, encode_frame, read_frame
+
+# Frames between the workers and the hub in the parent process, sent over a
+# Unix domain socket with the same framing as client connections
+CLAIM = 1          # request id + username, the hub answers with CLAIM_REPLY
+CLAIM_REPLY = 2    # request id + 1 if the username was free, 0 if taken
+RELEASE = 3        # username
+PUBLISH = 4        # room + newline + sender + newline + text, for the room's members on every other worker
+DIRECT = 5         # recipient + newline + sender + newline + text, routed to the recipient's worker only
+
+
+class BusHub:
+    """Relays broadcasts between worker processes and owns the global username registry"""
+
+    def __init__(self, path):
+        self.path = path
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen()
+        self.lock = threading.Lock()
+        self.workers = []      # (connection, send lock) of every connected worker
+        self.usernames = {}    # username -> connection of the worker holding it
+
+    def start(self):
+        threading.Thread(target=self.accept_workers, daemon=True).start()
+
+    def accept_workers(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            worker = (conn, threading.Lock())
+            with self.lock:
+                self.workers.append(worker)
+            threading.Thread(target=self.handle_worker, args=(worker,), daemon=True).start()
+
+    def send(self, worker, frame):
+        conn, send_lock = worker
+        try:
+            with send_lock:
+                conn.sendall(frame)
+        except OSError:
+            pass
+
+    def handle_worker(self, worker):
+        conn = worker[0]
+        decoder = FrameDecoder()
+        try:
+            while True:
+                frame = read_frame(conn, decoder)
+                if frame is None:
+                    break
+                frame_type, _, payload = frame
+
+                if frame_type == CLAIM:
+                    username = bytes(payload[4:]).decode('utf-8')
+                    with self.lock:
+                        free = username not in self.usernames
+                        if free:
+                            self.usernames[username] = conn
+                    self.send(worker, encode_frame(CLAIM_REPLY, bytes(payload[:4]) + bytes([free])))
+                elif frame_type == RELEASE:
+                    username = bytes(payload).decode('utf-8')
+                    with self.lock:
+                        if self.usernames.get(username) is conn:
+                            del self.usernames[username]
+                elif frame_type == PUBLISH:
+                    data = encode_frame(PUBLISH, bytes(payload))
+                    with self.lock:
+                        others = [w for w in self.workers if w[0] is not conn]
+                    for other in others:
+                        self.send(other, data)
+                elif frame_type == DIRECT:
+                    recipient, sender, message = bytes(payload).decode('utf-8').split('\n', 2)
+                    with self.lock:
+                        target = self.usernames.get(recipient)
+                        target = next((w for w in self.workers if w[0] is target), None)
+                    if target:
+                        self.send(target, encode_frame(DIRECT, bytes(payload)))
+                        # Echo it to the sender, through its own worker
+                        reply = f"{sender}\n\n{message}"
+                    else:
+                        reply = f"{sender}\n\nUser {recipient} is not online."
+                    self.send(worker, encode_frame(DIRECT, reply.encode('utf-8')))
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            # A dead worker's users are gone, free their names
+            with self.lock:
+                self.workers.remove(worker)
+                for username in [u for u, c in self.usernames.items() if c is conn]:
+                    del self.usernames[username]
+            conn.close()
+
+    def close(self):
+        self.listener.close()
+
+
+class BusClient:
+    """A worker's connection to the hub.
+
+    Claims block on a Future answered by the reader thread; published chat
+    text from other workers is handed to on_message, and direct messages for
+    this worker's users to on_direct, from that same thread.
+    """
+
+    def __init__(self, path, on_message, on_direct):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.on_message = on_message
+        self.on_direct = on_direct
+        self.send_lock = threading.Lock()
+        self.pending_claims = {}
+        self.request_ids = itertools.count(1)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def send(self, frame):
+        with self.send_lock:
+            self.sock.sendall(frame)
+
+    def claim(self, username):
+        """Ask the hub for username, returns a Future resolving to True if it was free"""
+        future = Future()
+        request_id = next(self.request_ids) % (1 << 32)
+        self.pending_claims[request_id] = future
+        self.send(encode_frame(CLAIM, request_id.to_bytes(4, byteorder='big') + username.encode('utf-8')))
+        return future
+
+    def release(self, username):
+        self.send(encode_frame(RELEASE, username.encode('utf-8')))
+
+    def publish(self, room_name, sender, message):
+        self.send(encode_frame(PUBLISH, f"{room_name}\n{sender}\n{message}".encode('utf-8')))
+
+    def send_direct(self, recipient, sender, message):
+        """Hand a direct message for a user on another worker to the hub"""
+        self.send(encode_frame(DIRECT, f"{recipient}\n{sender}\n{message}".encode('utf-8')))
+
+    def run(self):
+        decoder = FrameDecoder()
+        while True:
+            frame = read_frame(self.sock, decoder)
+            if frame is None:
+                # The hub only goes away when the whole server shuts down
+                os._exit(1)
+            frame_type, _, payload = frame
+            if frame_type == CLAIM_REPLY:
+                request_id = int.from_bytes(payload[:4], byteorder='big')
+                future = self.pending_claims.pop(request_id, None)
+                if future:
+                    future.set_result(payload[4] == 1)
+            elif frame_type == PUBLISH:
+                room_name, sender, message = bytes(payload).decode('utf-8').split('\n', 2)
+                self.on_message(room_name, sender, message)
+            elif frame_type == DIRECT:
+                recipient, _, message = bytes(payload).decode('utf-8').split('\n', 2)
+                self.on_direct(recipient, message)
+
+
+def run_worker(server_class, options, bus_path, worker_id):
+    if options.get('history_dir'):
+        # Every worker logs all broadcasts, its own and the bus's, to its own directory
+        options = dict(options, history_dir=os.path.join(options['history_dir'], f'worker-{worker_id}'))
+    if options.get('offline_dir'):
+        options = dict(options, offline_dir=os.path.join(options['offline_dir'], f'worker-{worker_id}'))
+    if options.get('metrics_port'):
+        # One admin port per worker, counting up from the given one
+        options = dict(options, metrics_port=options['metrics_port'] + worker_id)
+    server = server_class(reuse_port=True, **options)
+    server.bus = BusClient(bus_path, server.receive_from_bus, server.receive_direct_from_bus)
+    server.start()
+
+
+def run_cluster(server_class, workers, options):
+    """Fork workers that all accept on the same port with SO_REUSEPORT.
+
+    Pass a private_key (and ticket_key) in options so every worker presents
+    the same host key and accepts the others' resumption tickets.
+    """
+    bus_dir = tempfile.mkdtemp(prefix='chatroom-')
+    hub = BusHub(os.path.join(bus_dir, 'bus.sock'))
+    hub.start()
+
+    # Fork so the workers inherit the already loaded keys
+    context = multiprocessing.get_context('fork')
+    processes = [
+        context.Process(target=run_worker, args=(server_class, options, hub.path, worker_id))
+        for worker_id in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    print(f"Started {workers} worker processes")
+    # Installed after the fork, the workers keep the default action. Exiting
+    # through the finally below stops them and removes bus_dir.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        print("Server shutting down...")
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        hub.close()
+        shutil.rmtree(bus_dir, ignore_errors=True)
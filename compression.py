@@ -0,0 +1,59 @@
+import zlib
+from framing import MAX_FRAME_SIZE
+
+# Preset dictionary for both directions, so the first messages of a
+# connection already find the usual server phrases to refer back to
+DICTIONARY = (
+    b" has joined. has left. You left [. Now talking in [. is not online. is already taken."
+    b"Rooms (* = joined): members, talking here) Last messages in [general] [private]  -> : "
+)
+
+# Deflate's sync flush marker, stripped from the wire and added back on receipt
+SYNC_TRAILER = b'\x00\x00\xff\xff'
+
+
+class StreamCompression:
+    """Per-connection deflate streams, one for each direction.
+
+    Every message is compressed with a sync flush on a stream that lives as
+    long as the connection, so text repeated from earlier messages costs a few
+    bytes of back-reference instead of being sent again. Messages shorter than
+    threshold are sent as they are and do not touch the streams.
+
+    The streams are stateful like the cipher streams: compress messages in the
+    order they are sent, right before encrypting them, and decompress them in
+    the order they arrive. Each is only created for the first message that
+    needs it, an idle connection does not pay for deflate's buffers.
+    """
+
+    def __init__(self, threshold=32, level=6, max_size=MAX_FRAME_SIZE, dictionary=DICTIONARY):
+        self.threshold = threshold
+        self.level = level
+        self.max_size = max_size
+        self.dictionary = dictionary
+        self.compressor = None
+        self.decompressor = None
+
+    def compress(self, data):
+        """Return (data, True) with data compressed, or (data, False) if it is below the threshold"""
+        if len(data) < self.threshold:
+            return data, False
+        if self.compressor is None:
+            if self.dictionary:
+                self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, 8, zlib.Z_DEFAULT_STRATEGY,
+                                                   self.dictionary)
+            else:
+                self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        compressed = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        return compressed[:-len(SYNC_TRAILER)], True
+
+    def decompress(self, data):
+        if self.decompressor is None:
+            if self.dictionary:
+                self.decompressor = zlib.decompressobj(-15, zdict=self.dictionary)
+            else:
+                self.decompressor = zlib.decompressobj(-15)
+        data = self.decompressor.decompress(bytes(data) + SYNC_TRAILER, self.max_size)
+        if self.decompressor.unconsumed_tail:
+            raise ConnectionError(f"Compressed message expands beyond {self.max_size} bytes")
+        return data
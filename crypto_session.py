@@ -0,0 +1,74 @@
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.backends import default_backend
+
+
+class CryptoSession:
+    """AES-GCM for one connection, with a counter nonce per direction.
+
+    The session key and IV agreed in the handshake are expanded into a separate
+    key and nonce prefix for each direction, so client and server never share
+    a nonce. Each message is sealed under the prefix followed by the number of
+    messages sent before it, and carries a 16-byte tag that authenticates the
+    ciphertext together with the frame's type, flags and any plaintext prefix
+    (the mailbox sequence), so a changed, dropped, replayed or reordered frame
+    fails to decrypt and the connection is closed instead.
+
+    Because the counters are stateful, every encrypted message has to reach the
+    peer, in order. Callers must encrypt at the moment a message is written to
+    the socket, not when it is queued.
+    """
+
+    def __init__(self, session_key, iv, is_server):
+        client_to_server = self.derive(session_key, iv, b'chatroom client to server')
+        server_to_client = self.derive(session_key, iv, b'chatroom server to client')
+
+        if is_server:
+            send_params, recv_params = server_to_client, client_to_server
+        else:
+            send_params, recv_params = client_to_server, server_to_client
+
+        self.encryptor = AESGCM(send_params[:32])
+        self.send_prefix = send_params[32:]
+        self.sent = 0
+        self.decryptor = AESGCM(recv_params[:32])
+        self.recv_prefix = recv_params[32:]
+        self.received = 0
+
+    @staticmethod
+    def derive(session_key, iv, label):
+        """Derive a 32-byte AES key followed by a 4-byte nonce prefix"""
+        return HKDF(
+            algorithm=hashes.SHA256(),
+            length=36,
+            salt=iv,
+            info=label,
+            backend=default_backend()
+        ).derive(session_key)
+
+    def encrypt(self, data, frame_type, flags=0, prefix=b''):
+        nonce = self.send_prefix + self.sent.to_bytes(8, byteorder='big')
+        self.sent += 1
+        return self.encryptor.encrypt(nonce, data, bytes([frame_type, flags]) + prefix)
+
+    def decrypt(self, data, frame_type, flags=0, prefix=b''):
+        nonce = self.recv_prefix + self.received.to_bytes(8, byteorder='big')
+        self.received += 1
+        try:
+            return self.decryptor.decrypt(nonce, bytes(data), bytes([frame_type, flags]) + bytes(prefix))
+        except InvalidTag:
+            raise ConnectionError("Frame failed authentication") from None
+
+
+def derive_resumed_secret(resumption_secret, client_nonce, server_nonce):
+    """Session key and IV for a connection resumed with a ticket, no RSA involved"""
+    secret = HKDF(
+        algorithm=hashes.SHA256(),
+        length=48,
+        salt=client_nonce + server_nonce,
+        info=b'chatroom resume',
+        backend=default_backend()
+    ).derive(resumption_secret)
+    return secret[:32], secret[32:]
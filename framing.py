@@ -0,0 +1,239 @@
+import struct
+
+# Every frame is a 6 byte header followed by the payload:
+#   payload length (uint32), frame type (uint8), flags (uint8)
+HEADER = struct.Struct('!IBB')
+
+# Handshake frames
+PUBLIC_KEY = 1      # PEM encoded RSA public key, both directions
+SESSION_KEY = 2     # AES session key + IV, wrapped together with the server's public key
+USERNAME = 4        # username, encrypted with the session
+
+# Chat frames
+MESSAGE = 5         # chat text encrypted with the sender's session stream
+GROUP_KEY = 6       # epoch + room key wrapped with the client's public key
+GROUP_MESSAGE = 7   # epoch + nonce + chat text encrypted with the room key
+
+# Session resumption frames
+RESUME = 8          # client nonce + ticket, sent instead of the client's public key
+RESUME_OK = 9       # server nonce, the client continues with USERNAME
+RESUME_FAILED = 10  # ticket rejected, the client continues with a full handshake
+TICKET = 11         # resumption secret + ticket for the next connection, session encrypted
+
+# Room frames, client to server, payload encrypted with the session stream
+JOIN = 12           # room name, also makes it the room MESSAGE frames go to
+PART = 13           # room name
+LIST_ROOMS = 14     # empty, the server answers with a MESSAGE
+DIRECT = 15         # recipient username + newline + text, encrypted with the session stream
+HISTORY = 16        # message count, or minutes followed by 'm', the server answers with a MESSAGE
+
+# Keepalive frames, empty and unencrypted so they never touch the session stream
+PING = 17           # server to an idle client
+PONG = 18           # the client's answer to PING
+ACK = 19            # mailbox id + highest sequence number the client has received, unencrypted
+
+# File transfer frames, encrypted with the session stream chunk by chunk and never compressed
+FILE_OFFER = 20     # FILE_HEADER + file name; from the server, room + newline + sender + newline + file name
+FILE_CHUNK = 21     # FILE_ID + up to FILE_CHUNK_SIZE bytes of the file
+FILE_END = 22       # FILE_ID + FILE_DONE or FILE_CANCELLED
+FILE_CREDIT = 23    # server to sender, unencrypted: FILE_CREDIT_GRANT, a grant of 0 stops the transfer
+
+# Frame flags
+COMPRESSED = 0x01   # on PUBLIC_KEY the server offers compression, on USERNAME the client takes it,
+                    # on MESSAGE and the room frames the payload is deflate compressed before encryption
+SEQUENCED = 0x02    # on MESSAGE and GROUP_MESSAGE the payload starts with a SEQUENCE, outside the encryption
+
+# Mailbox id and sequence number of a message, see offline.Mailbox
+SEQUENCE = struct.Struct('!II')
+
+# Transfer id and file size. The sender picks the id of its FILE_OFFER, the
+# server gives each relayed file its own id for the recipients
+FILE_HEADER = struct.Struct('!IQ')
+FILE_ID = struct.Struct('!I')
+# Transfer id and the number of further chunks the sender may send
+FILE_CREDIT_GRANT = struct.Struct('!II')
+FILE_DONE = 0
+FILE_CANCELLED = 1
+FILE_CHUNK_SIZE = 32 * 1024
+
+MAX_FRAME_SIZE = 1024 * 1024
+
+# Most buffers handed to a single sendmsg call (the usual IOV_MAX)
+MAX_IOVECS = 1024
+
+
+def encode_frame(frame_type, payload, flags=0):
+    return HEADER.pack(len(payload), frame_type, flags) + payload
+
+
+def expect_frame(frame, frame_type):
+    """Return the payload of a handshake frame, or fail if it is missing or of the wrong type"""
+    if frame is None:
+        raise ConnectionError("Connection closed during handshake")
+    if frame[0] != frame_type:
+        raise ConnectionError(f"Expected frame type {frame_type}, got {frame[0]}")
+    return bytes(frame[2])
+
+
+class FrameDecoder:
+    """Reassembles frames from a byte stream without per-chunk copies.
+
+    Data is received straight into a preallocated bytearray (recv_into the
+    memoryview returned by get_buffer, then report the byte count with
+    buffer_updated). next_frame hands out complete frames as memoryview slices
+    of that buffer, so a payload is only valid until get_buffer is called
+    again; decrypt or copy it before reading more.
+
+    Partial frames stay in the buffer until the rest arrives and several
+    frames received in one recv are returned one by one. The buffer grows for
+    frames larger than it and shrinks back once drained, so idle connections
+    only hold initial_size bytes.
+    """
+
+    def __init__(self, initial_size=4096, max_frame_size=MAX_FRAME_SIZE):
+        self.initial_size = initial_size
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray(initial_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first unconsumed byte
+        self.end = 0    # end of received data
+
+    def pending(self):
+        """Number of received bytes that do not form a complete frame yet"""
+        return self.end - self.start
+
+    def needed(self):
+        """Total size of the frame currently being received, header included"""
+        if self.end - self.start < HEADER.size:
+            return HEADER.size
+        length, _, _ = HEADER.unpack_from(self.buffer, self.start)
+        if length > self.max_frame_size:
+            raise ConnectionError(f"Frame of {length} bytes exceeds the {self.max_frame_size} byte limit")
+        return HEADER.size + length
+
+    def get_buffer(self):
+        """Writable memoryview of the free space at the end of the buffer"""
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buffer) > self.initial_size:
+                self.resize(self.initial_size)
+
+        needed = self.needed()
+        if len(self.buffer) - self.start < needed:
+            # The frame doesn't fit even at the front of the buffer
+            self.resize(max(needed, len(self.buffer) * 2))
+        elif len(self.buffer) - self.end < min(needed, 1024) or self.end == len(self.buffer):
+            # Move the partial frame to the front to make room behind it
+            pending = self.end - self.start
+            self.view[:pending] = self.view[self.start:self.end]
+            self.start, self.end = 0, pending
+
+        if self.end == len(self.buffer):
+            # Only possible when complete frames fill the buffer, see feed()
+            self.resize(len(self.buffer) * 2)
+        return self.view[self.end:]
+
+    def resize(self, size):
+        pending = self.end - self.start
+        buffer = bytearray(size)
+        buffer[:pending] = self.view[self.start:self.end]
+        self.view.release()
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.start, self.end = 0, pending
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+
+    def feed(self, data):
+        """Copy data into the buffer, for callers that don't receive into it directly"""
+        data = memoryview(data)
+        while data:
+            buffer = self.get_buffer()
+            n = min(len(buffer), len(data))
+            buffer[:n] = data[:n]
+            self.buffer_updated(n)
+            data = data[n:]
+
+    def next_frame(self):
+        """Return (frame_type, flags, payload memoryview) or None if no complete frame is buffered"""
+        if self.end - self.start < HEADER.size:
+            return None
+        length, frame_type, flags = HEADER.unpack_from(self.buffer, self.start)
+        if length > self.max_frame_size:
+            raise ConnectionError(f"Frame of {length} bytes exceeds the {self.max_frame_size} byte limit")
+        frame_end = self.start + HEADER.size + length
+        if frame_end > self.end:
+            return None
+        payload = self.view[self.start + HEADER.size:frame_end]
+        self.start = frame_end
+        return frame_type, flags, payload
+
+
+def read_frame(sock, decoder):
+    """Block until the next frame arrives on sock, None if the peer closed the connection"""
+    while True:
+        frame = decoder.next_frame()
+        if frame is not None:
+            return frame
+        nbytes = sock.recv_into(decoder.get_buffer())
+        if not nbytes:
+            if decoder.pending():
+                raise ConnectionError("Connection closed in the middle of a frame")
+            return None
+        decoder.buffer_updated(nbytes)
+
+
+async def read_frame_async(loop, sock, decoder):
+    """read_frame for a non-blocking socket on an asyncio event loop"""
+    while True:
+        frame = decoder.next_frame()
+        if frame is not None:
+            return frame
+        nbytes = await loop.sock_recv_into(sock, decoder.get_buffer())
+        if not nbytes:
+            if decoder.pending():
+                raise ConnectionError("Connection closed in the middle of a frame")
+            return None
+        decoder.buffer_updated(nbytes)
+
+
+def unsent(buffers, sent):
+    """Drop the first sent bytes from a list of memoryviews, returns what is left"""
+    i = 0
+    while i < len(buffers) and sent >= len(buffers[i]):
+        sent -= len(buffers[i])
+        i += 1
+    buffers = buffers[i:]
+    if sent:
+        buffers[0] = buffers[0][sent:]
+    return buffers
+
+
+def send_buffers(sock, buffers):
+    """Write several frames with one sendmsg (writev) call, continuing after partial writes"""
+    if not hasattr(sock, 'sendmsg'):
+        # No sendmsg on Windows, one joined write is the next best thing
+        sock.sendall(b''.join(buffers))
+        return
+    buffers = [memoryview(b) for b in buffers]
+    while buffers:
+        buffers = unsent(buffers, sock.sendmsg(buffers[:MAX_IOVECS]))
+
+
+async def send_buffers_async(loop, sock, buffers):
+    """send_buffers for a non-blocking socket on an asyncio event loop"""
+    if not hasattr(sock, 'sendmsg'):
+        await loop.sock_sendall(sock, b''.join(buffers))
+        return
+    buffers = [memoryview(b) for b in buffers]
+    while buffers:
+        try:
+            sent = sock.sendmsg(buffers[:MAX_IOVECS])
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        buffers = unsent(buffers, sent)
+        if buffers and not sent:
+            # Socket buffer full, let the loop wait until it is writable again
+            await loop.sock_sendall(sock, b''.join(buffers))
+            return
@@ -0,0 +1,215 @@
+import mmap
+import os
+import struct
+import threading
+import time
+from bisect import bisect_left
+
+# Every record is a fixed header followed by the UTF-8 room, sender and body:
+#   timestamp (float64), room length (uint16), sender length (uint16), body length (uint32)
+RECORD = struct.Struct('!dHHI')
+SEGMENT_SUFFIX = '.log'
+
+
+def encode_record(timestamp, room, sender, body):
+    room, sender, body = room.encode('utf-8'), sender.encode('utf-8'), body.encode('utf-8')
+    return RECORD.pack(timestamp, len(room), len(sender), len(body)) + room + sender + body
+
+
+def decode_record(data, offset=0):
+    """Return (timestamp, room, sender, body, end offset), or None if the record is incomplete"""
+    if len(data) - offset < RECORD.size:
+        return None
+    timestamp, room_len, sender_len, body_len = RECORD.unpack_from(data, offset)
+    start = offset + RECORD.size
+    end = start + room_len + sender_len + body_len
+    if end > len(data):
+        return None
+    room = data[start:start + room_len].decode('utf-8')
+    sender = data[start + room_len:start + room_len + sender_len].decode('utf-8')
+    body = data[start + room_len + sender_len:end].decode('utf-8')
+    return timestamp, room, sender, body, end
+
+
+class MessageLog:
+    """Append-only chat history stored in numbered segment files.
+
+    append() only encodes the record and queues it. A writer thread writes the
+    queue in batches and fsyncs once per batch, so the broadcast path never
+    waits for the disk. An in-memory index maps every room to the
+    (timestamp, segment, offset) of its records and reads go through mmaps of
+    the segments, so replaying the last N messages of a room touches exactly N
+    records. Segments roll over at segment_bytes and only the newest
+    max_segments are kept.
+    """
+
+    def __init__(self, directory, segment_bytes=16 * 1024 * 1024, max_segments=8, flush_interval=0.1):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        # The segment being written is never the one retention removes
+        self.max_segments = max(2, max_segments)
+        self.flush_interval = flush_interval
+        self.cond = threading.Condition()
+        self.pending = []      # (room, timestamp, record) waiting for the writer
+        self.writing = []      # the batch being written, readable until it is indexed
+        self.index = {}        # room -> [(timestamp, segment, offset)] in append order
+        self.maps = {}         # segment -> mmap of the segment file
+        self.last_timestamp = 0
+        self.closed = False
+
+        self.segments = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)])
+            for name in os.listdir(directory)
+            if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit()
+        )
+        for segment in self.segments:
+            self.load_segment(segment)
+        if not self.segments:
+            self.segments.append(1)
+        self.file = open(self.path(self.segments[-1]), 'ab')
+        self.size = self.file.tell()
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def path(self, segment):
+        return os.path.join(self.directory, f"{segment:08d}{SEGMENT_SUFFIX}")
+
+    def load_segment(self, segment):
+        """Index the records of an existing segment, cutting off a record torn by a crash"""
+        with open(self.path(segment), 'r+b') as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                offset = 0
+                while True:
+                    record = decode_record(data, offset)
+                    if record is None:
+                        break
+                    timestamp, room = record[0], record[1]
+                    self.index.setdefault(room, []).append((timestamp, segment, offset))
+                    self.last_timestamp = max(self.last_timestamp, timestamp)
+                    offset = record[4]
+            if offset < size:
+                print(f"Truncating {size - offset} bytes of incomplete history in {self.path(segment)}")
+                f.truncate(offset)
+
+    def append(self, room, sender, body):
+        with self.cond:
+            if self.closed:
+                return
+            # Timestamps never go backwards so the index can be searched by time
+            timestamp = self.last_timestamp = max(time.time(), self.last_timestamp)
+            self.pending.append((room, timestamp, encode_record(timestamp, room, sender, body)))
+            self.cond.notify()
+
+    def recent(self, room, limit=50, since=None):
+        """The last limit messages of a room as (timestamp, sender, body), oldest first.
+
+        With since, only messages from that Unix time on are returned.
+        """
+        with self.cond:
+            entries = self.index.get(room, [])
+            start = bisect_left(entries, (since,)) if since is not None else 0
+            unindexed = [
+                (timestamp, record) for r, timestamp, record in self.writing + self.pending
+                if r == room and (since is None or timestamp >= since)
+            ]
+            start = max(start, len(entries) - max(0, limit - len(unindexed)))
+
+            messages = []
+            for timestamp, segment, offset in entries[start:]:
+                _, _, sender, body, _ = decode_record(self.read_map(segment, offset), offset)
+                messages.append((timestamp, sender, body))
+            for timestamp, record in unindexed:
+                _, _, sender, body, _ = decode_record(record)
+                messages.append((timestamp, sender, body))
+        return messages[-limit:] if limit else []
+
+    def read_map(self, segment, offset):
+        """mmap of a segment covering the record at offset, remapped if the segment grew"""
+        data = self.maps.get(segment)
+        if data is None or decode_record(data, offset) is None:
+            if data is not None:
+                data.close()
+            with open(self.path(segment), 'rb') as f:
+                data = self.maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return data
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+            if not self.closed:
+                # Let a batch build up instead of writing every message on its own
+                time.sleep(self.flush_interval)
+            with self.cond:
+                batch, self.pending = self.pending, []
+                self.writing = batch
+            self.write_batch(batch)
+
+    def write_batch(self, batch):
+        entries, chunks = [], []
+        for room, timestamp, record in batch:
+            if self.size and self.size + len(record) > self.segment_bytes:
+                self.write_chunks(chunks)
+                with self.cond:
+                    self.add_entries(entries)
+                    self.rotate()
+                entries, chunks = [], []
+            entries.append((room, (timestamp, self.segments[-1], self.size)))
+            chunks.append(record)
+            self.size += len(record)
+        self.write_chunks(chunks)
+        with self.cond:
+            self.add_entries(entries)
+            self.writing = []
+
+    def write_chunks(self, chunks):
+        if chunks:
+            self.file.write(b''.join(chunks))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def add_entries(self, entries):
+        for room, entry in entries:
+            self.index.setdefault(room, []).append(entry)
+
+    def rotate(self):
+        """Start a new segment and drop the oldest ones past max_segments, called with the lock held"""
+        self.file.close()
+        self.segments.append(self.segments[-1] + 1)
+        self.file = open(self.path(self.segments[-1]), 'ab')
+        self.size = 0
+
+        while len(self.segments) > self.max_segments:
+            segment = self.segments.pop(0)
+            data = self.maps.pop(segment, None)
+            if data is not None:
+                data.close()
+            os.remove(self.path(segment))
+            # Records are indexed in append order, so the removed ones are at the front
+            for room in list(self.index):
+                entries = self.index[room]
+                keep = 0
+                while keep < len(entries) and entries[keep][1] == segment:
+                    keep += 1
+                if keep == len(entries):
+                    del self.index[room]
+                elif keep:
+                    del entries[:keep]
+
+    def close(self):
+        """Write out everything appended so far and stop the writer"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+        self.file.close()
+        for data in self.maps.values():
+            data.close()
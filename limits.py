@@ -0,0 +1,96 @@
+import threading
+import time
+from math import ceil
+from logger import log
+
+
+class TokenBucket:
+    """Allows rate events per second on average, with bursts of up to burst events.
+
+    refused counts the events turned away since the last allowed one, so the
+    caller can warn once per burst instead of once per dropped message.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.refused = 0
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            self.refused += 1
+            return False
+        self.tokens -= 1
+        self.refused = 0
+        return True
+
+
+class WheelTimer:
+    __slots__ = ('callback', 'rounds', 'cancelled')
+
+    def __init__(self, callback, rounds):
+        self.callback = callback
+        self.rounds = rounds
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    """Hashed timing wheel: thousands of connection timeouts for one ticking thread or loop callback.
+
+    Timers land in the slot their deadline falls on, delays longer than one
+    turn of the wheel wait there for the extra rounds. Scheduling and
+    cancelling are O(1) (a cancelled timer stays in its slot and is skipped),
+    every tick only looks at one slot. Deadlines are rounded up to whole
+    ticks, so a timer fires up to one tick late but never early.
+
+    Call advance regularly, from run_forever in a thread or from an event
+    loop. Callbacks run there, outside the wheel's lock, and may schedule
+    new timers.
+    """
+
+    def __init__(self, tick=0.5, slots=256):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = 0
+        self.last_tick = time.monotonic()
+        self.lock = threading.Lock()
+
+    def schedule(self, delay, callback):
+        with self.lock:
+            # Counted from the last tick, which may be most of a tick ago
+            ticks = max(1, ceil((delay + time.monotonic() - self.last_tick) / self.tick))
+            timer = WheelTimer(callback, (ticks - 1) // len(self.slots))
+            self.slots[(self.current + ticks) % len(self.slots)].append(timer)
+        return timer
+
+    def advance(self):
+        """Fire the timers of every tick that has passed since the last call"""
+        now = time.monotonic()
+        while now - self.last_tick >= self.tick:
+            with self.lock:
+                self.last_tick += self.tick
+                self.current = (self.current + 1) % len(self.slots)
+                slot = self.slots[self.current]
+                due = [timer for timer in slot if not timer.rounds and not timer.cancelled]
+                waiting = [timer for timer in slot if timer.rounds and not timer.cancelled]
+                for timer in waiting:
+                    timer.rounds -= 1
+                self.slots[self.current] = waiting
+            for timer in due:
+                try:
+                    timer.callback()
+                except Exception as e:
+                    log(f"Timer callback failed: {e}")
+
+    def run_forever(self):
+        while True:
+            time.sleep(self.tick)
+            self.advance()
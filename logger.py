@@ -0,0 +1,70 @@
+import atexit
+import sys
+import threading
+from collections import deque
+
+
+class BufferedLogger:
+    """Line logger that keeps stdout writes off the calling thread.
+
+    log() only appends the line to a queue, which is safe without a lock and
+    cheap enough to call while holding the server lock. A writer thread joins
+    whatever has queued up into a single write every interval seconds. When
+    stdout can't keep up, lines beyond max_lines are dropped and counted
+    instead of letting the queue grow without bound.
+    """
+
+    def __init__(self, stream=None, interval=0.05, max_lines=100000):
+        self.stream = stream
+        self.interval = interval
+        self.max_lines = max_lines
+        self.lines = deque()
+        self.dropped = 0
+        self.wakeup = threading.Event()
+        self.write_lock = threading.Lock()
+        self.thread = None
+        self.start_lock = threading.Lock()
+
+    def log(self, message):
+        if len(self.lines) >= self.max_lines:
+            self.dropped += 1
+            return
+        self.lines.append(message)
+        if self.thread is None:
+            self.start()
+
+    def start(self):
+        with self.start_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+                atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Write out everything logged so far"""
+        with self.write_lock:
+            lines = []
+            while self.lines:
+                lines.append(self.lines.popleft())
+            if self.dropped:
+                lines.append(f"({self.dropped} log lines dropped, output too slow)")
+                self.dropped = 0
+            if not lines:
+                return
+            stream = self.stream or sys.stdout
+            try:
+                stream.write('\n'.join(lines) + '\n')
+                stream.flush()
+            except (OSError, ValueError):
+                pass
+
+
+default_logger = BufferedLogger()
+log = default_logger.log
+flush = default_logger.flush
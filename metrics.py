@@ -0,0 +1,227 @@
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as StackCounter
+
+# Upper bounds in seconds, from handshake-sized to microsecond crypto calls
+DEFAULT_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in sorted(labels.items())) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=None):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name + format_labels(self.labels), self.value)]
+
+
+class Gauge:
+    """A value read at scrape time from function, so the hot path never updates it"""
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, function, labels=None):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.function = function
+
+    def samples(self):
+        return [(self.name + format_labels(self.labels), self.function())]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS, labels=None):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        """Context manager observing the duration of its block"""
+        return Timer(self)
+
+    def samples(self):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            samples.append((f"{self.name}_bucket" + format_labels(dict(self.labels or {}, le=bound)), cumulative))
+        samples.append((f"{self.name}_sum" + format_labels(self.labels), total))
+        samples.append((f"{self.name}_count" + format_labels(self.labels), cumulative))
+        return samples
+
+
+class Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Registry:
+    """Collects metrics and renders them in the Prometheus text format"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=None):
+        return self.add(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, function, labels=None):
+        return self.add(Gauge(name, help_text, function, labels))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS, labels=None):
+        return self.add(Histogram(name, help_text, buckets, labels))
+
+    def render(self):
+        lines = []
+        described = set()
+        for metric in self.metrics:
+            # Metrics sharing a name with different labels share one HELP/TYPE header
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, value in metric.samples():
+                lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+class ServerMetrics:
+    """Every metric the chat server keeps, updated from the connection and message paths"""
+
+    def __init__(self, server):
+        self.registry = registry = Registry()
+        registry.gauge('chat_connections_active', 'Connected users', lambda: len(server.clients))
+        self.connections = registry.counter('chat_connections_total', 'Accepted TCP connections')
+        self.refused = registry.counter('chat_connections_refused_total', 'Connections closed because of --max-connections')
+        self.timeouts = {
+            stage: registry.counter('chat_connections_timed_out_total', 'Connections closed for a handshake or idle timeout',
+                                    labels={'stage': stage})
+            for stage in ('handshake', 'idle')
+        }
+        self.handshakes = registry.histogram('chat_handshake_seconds', 'Time from accept to a complete handshake')
+        self.messages_in = registry.counter('chat_messages_received_total', 'Frames received from users after the handshake')
+        self.bytes_in = registry.counter('chat_received_bytes_total', 'Payload bytes received from users after the handshake')
+        self.rate_limited = registry.counter('chat_messages_rate_limited_total', 'Frames dropped by the per-user rate limit')
+        self.messages_out = registry.counter('chat_messages_queued_total', 'Messages queued for delivery to users')
+        self.bytes_out = registry.counter('chat_sent_bytes_total', 'Bytes written to user sockets by the outboxes')
+        self.compress_in = registry.counter('chat_compression_input_bytes_total',
+                                            'Bytes of outgoing messages before compression')
+        self.compress_out = registry.counter('chat_compression_output_bytes_total',
+                                             'Bytes of the same messages after compression')
+        self.writes = registry.counter('chat_socket_writes_total', 'Batched socket writes by the outboxes')
+        self.dropped = registry.counter('chat_outbox_dropped_total', 'Messages dropped by the drop-oldest policy')
+        self.fanout = registry.histogram('chat_broadcast_seconds', 'Time to queue one broadcast for every local room member')
+        registry.gauge('chat_outbox_queued_bytes', 'Bytes waiting in all outboxes',
+                       lambda: sum(client.outbox.queued_bytes for client in server.clients.values()))
+        registry.gauge('chat_outbox_queued_max_bytes', 'Bytes waiting in the fullest outbox',
+                       lambda: max((client.outbox.queued_bytes for client in server.clients.values()), default=0))
+        registry.gauge('chat_offline_mailboxes', 'Disconnected users whose messages are being kept',
+                       lambda: sum(1 for mailbox in list(server.mailboxes.values()) if mailbox.offline))
+        self.held = registry.counter('chat_offline_held_total', 'Messages kept for disconnected users')
+        self.file_bytes = registry.counter('chat_file_bytes_total', 'Bytes of files received from senders for relaying')
+        registry.gauge('chat_rooms', 'Rooms with local members',
+                       lambda: sum(1 for room in list(server.rooms.values()) if room.members))
+        self.encrypt = registry.histogram('chat_crypto_seconds', 'Time spent in one crypto call',
+                                          labels={'operation': 'session_encrypt'})
+        self.decrypt = registry.histogram('chat_crypto_seconds', 'Time spent in one crypto call',
+                                          labels={'operation': 'session_decrypt'})
+        self.group_encrypt = registry.histogram('chat_crypto_seconds', 'Time spent in one crypto call',
+                                                labels={'operation': 'group_encrypt'})
+        self.unwrap = registry.histogram('chat_crypto_seconds', 'Time spent in one crypto call',
+                                         labels={'operation': 'rsa_unwrap'})
+
+
+class SamplingProfiler:
+    """Statistical profiler: samples the stacks of all threads every interval seconds.
+
+    The report is in the collapsed stack format ("outer;inner;leaf count"),
+    which flame graph tools read directly. Sampling costs nothing while the
+    profiler is stopped.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = StackCounter()
+        self.samples = 0
+        self.running = False
+        self.thread = None
+        self.started = None
+
+    def start(self):
+        if self.running:
+            return False
+        self.stacks.clear()
+        self.samples = 0
+        self.running = True
+        self.started = time.monotonic()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        if not self.running:
+            return None
+        self.running = False
+        self.thread.join()
+        return self.report()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while self.running:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def report(self):
+        lines = [f"# {self.samples} samples every {self.interval * 1000:g} ms over "
+                 f"{time.monotonic() - self.started:.1f} s"]
+        lines += [f"{stack} {count}" for stack, count in self.stacks.most_common()]
+        return '\n'.join(lines) + '\n'
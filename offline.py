@@ -0,0 +1,217 @@
+import hashlib
+import os
+import random
+import struct
+import threading
+import time
+from collections import deque
+from logger import log
+
+# Every record in a queue file is a header followed by the body:
+#   kind (uint8), body length (uint32)
+RECORD = struct.Struct('!BI')
+STATE = 1    # mailbox id, next sequence number, lost count (uint32 each), owner key length (uint16),
+             # then the owner's public key (DER) and the username and rooms, one per line
+MESSAGE = 2  # sequence number (uint32), then the UTF-8 message
+STATE_HEADER = struct.Struct('!IIIH')
+SEQ = struct.Struct('!I')
+QUEUE_SUFFIX = '.queue'
+
+
+class Sequenced:
+    """An outbox item carrying the mailbox id and sequence number it goes out with"""
+    __slots__ = ('mailbox', 'seq', 'message')
+
+    def __init__(self, mailbox, seq, message):
+        self.mailbox = mailbox
+        self.seq = seq
+        self.message = message  # chat text, or a GROUP_MESSAGE frame shared by the room
+
+    def __len__(self):
+        return len(self.message)
+
+
+class Mailbox:
+    """Messages sent to one user that the user's client has not acknowledged yet.
+
+    Each message gets the next sequence number of the mailbox; the client acks
+    the highest number it has seen, which drops everything up to it. While the
+    user is connected this only holds what is in flight. When the user
+    disconnects the mailbox stays for a while, keeps collecting the messages
+    of the user's rooms and private messages, and on reconnect everything
+    unacknowledged is sent again with its original number, so the client can
+    skip what it already has.
+
+    The id changes whenever a mailbox is created, telling the client to start
+    counting again. At most max_messages are kept, the oldest go first. owner
+    is the DER public key of the client the mailbox belongs to; only a client
+    with that key gets the held messages.
+    """
+
+    def __init__(self, max_messages=1000, mailbox_id=None, owner=b''):
+        self.id = mailbox_id or random.randrange(1, 2 ** 32)
+        self.owner = owner
+        self.next_seq = 1
+        self.pending = deque()  # (seq, message)
+        self.max_messages = max_messages
+        # Held between the add() that numbers a message and the outbox put, so
+        # messages are queued in the order of their numbers
+        self.lock = threading.RLock()
+        self.offline = False
+        self.rooms = []   # rooms the user was in when disconnecting, the active one last
+        self.lost = 0     # messages dropped for lack of space while offline
+        self.expiry = None
+
+    def add(self, message):
+        seq = self.next_seq
+        self.next_seq += 1
+        if len(self.pending) >= self.max_messages:
+            self.pending.popleft()
+            if self.offline:
+                self.lost += 1
+        self.pending.append((seq, message))
+        return seq
+
+    def ack(self, mailbox_id, seq):
+        if mailbox_id != self.id:
+            return
+        with self.lock:
+            while self.pending and self.pending[0][0] <= seq:
+                self.pending.popleft()
+
+
+def queue_file_name(username):
+    return hashlib.sha256(username.encode('utf-8')).hexdigest()[:32] + QUEUE_SUFFIX
+
+
+def encode_state(username, mailbox):
+    body = STATE_HEADER.pack(mailbox.id, mailbox.next_seq, mailbox.lost, len(mailbox.owner)) + mailbox.owner + \
+        '\n'.join([username] + mailbox.rooms).encode('utf-8')
+    return RECORD.pack(STATE, len(body)) + body
+
+
+def encode_message(seq, message):
+    body = SEQ.pack(seq) + message.encode('utf-8')
+    return RECORD.pack(MESSAGE, len(body)) + body
+
+
+class OfflineStore:
+    """Queue files of offline users' mailboxes, so a server restart does not lose them.
+
+    A file is written when its user disconnects (state and pending messages)
+    and appended to for every message held afterwards; it is removed when the
+    user comes back or the mailbox expires. Like MessageLog, the callers only
+    encode and queue, a writer thread does the disk work in batches.
+    """
+
+    def __init__(self, directory, flush_interval=0.1):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.cond = threading.Condition()
+        self.pending = []  # (file name, data, truncate) in order, data None removes the file
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def queue(self, username, data, truncate=False):
+        with self.cond:
+            if self.closed:
+                return
+            self.pending.append((queue_file_name(username), data, truncate))
+            self.cond.notify()
+
+    def save(self, username, mailbox):
+        """Write a mailbox that has just gone offline, replacing any older file of the user"""
+        data = encode_state(username, mailbox) + b''.join(
+            encode_message(seq, message) for seq, message in mailbox.pending
+        )
+        self.queue(username, data, truncate=True)
+
+    def append(self, username, seq, message):
+        self.queue(username, encode_message(seq, message))
+
+    def remove(self, username):
+        self.queue(username, None)
+
+    def load(self, max_messages=1000):
+        """Read every queue file, returns {username: Mailbox} with the mailboxes offline"""
+        mailboxes = {}
+        for name in os.listdir(self.directory):
+            if not name.endswith(QUEUE_SUFFIX):
+                continue
+            with open(self.path(name), 'rb') as f:
+                data = f.read()
+            username, mailbox, offset = None, None, 0
+            while len(data) - offset >= RECORD.size:
+                kind, length = RECORD.unpack_from(data, offset)
+                body = data[offset + RECORD.size:offset + RECORD.size + length]
+                if len(body) < length:
+                    break  # torn by a crash
+                offset += RECORD.size + length
+                if kind == STATE:
+                    mailbox_id, next_seq, lost, owner_len = STATE_HEADER.unpack_from(body)
+                    names = STATE_HEADER.size + owner_len
+                    username, *rooms = body[names:].decode('utf-8').split('\n')
+                    mailbox = Mailbox(max_messages, mailbox_id, body[STATE_HEADER.size:names])
+                    mailbox.next_seq, mailbox.lost, mailbox.rooms = next_seq, lost, rooms
+                    mailbox.offline = True
+                elif kind == MESSAGE and mailbox:
+                    seq = SEQ.unpack_from(body)[0]
+                    mailbox.next_seq = max(mailbox.next_seq, seq + 1)
+                    mailbox.pending.append((seq, body[SEQ.size:].decode('utf-8')))
+            if not mailbox:
+                os.remove(self.path(name))
+                continue
+            while len(mailbox.pending) > max_messages:
+                mailbox.pending.popleft()
+                mailbox.lost += 1
+            mailboxes[username] = mailbox
+        return mailboxes
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                batch, self.pending = self.pending, []
+            self.write_batch(batch)
+            time.sleep(self.flush_interval)
+
+    def write_batch(self, batch):
+        files = {}
+        try:
+            for name, data, truncate in batch:
+                if data is None:
+                    if name in files:
+                        files.pop(name).close()
+                    try:
+                        os.remove(self.path(name))
+                    except FileNotFoundError:
+                        pass
+                    continue
+                if truncate and name in files:
+                    files.pop(name).close()
+                if name not in files:
+                    files[name] = open(self.path(name), 'wb' if truncate else 'ab')
+                files[name].write(data)
+            for f in files.values():
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            log(f"Failed to write offline queues: {e}")
+        finally:
+            for f in files.values():
+                f.close()
+
+    def close(self):
+        """Write out what is queued and stop the writer"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
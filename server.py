@@ -1,255 +1,1612 @@
+import time
+# Taken before the other imports so --benchmark-startup covers them too
+PROCESS_START = time.perf_counter()
 import socket
 import threading
-import time
+import asyncio
 import argparse
-import requests
+import hashlib
 import json
 import sys
-import base64
 import os
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.backends import default_backend
+from crypto_session import CryptoSession, derive_resumed_secret
+from compression import StreamCompression
+from history import MessageLog
+from limits import TimerWheel, TokenBucket
+from offline import Mailbox, OfflineStore, Sequenced
+from transfer import FileFrame, Transfer, format_size, safe_file_name, MAX_FILE_NAME
+from logger import log, flush as flush_log
+from metrics import ServerMetrics
+from framing import (FrameDecoder, HEADER, SEQUENCE, encode_frame, expect_frame, read_frame, read_frame_async,
+                     send_buffers, send_buffers_async, MAX_IOVECS, COMPRESSED, SEQUENCED,
+                     PUBLIC_KEY, SESSION_KEY, USERNAME, MESSAGE, GROUP_KEY, GROUP_MESSAGE,
+                     RESUME, RESUME_OK, RESUME_FAILED, TICKET, JOIN, PART, LIST_ROOMS, DIRECT, HISTORY, PING, ACK,
+                     FILE_OFFER, FILE_CHUNK, FILE_END, FILE_CREDIT, FILE_HEADER, FILE_ID, FILE_CREDIT_GRANT,
+                     FILE_DONE, FILE_CANCELLED, FILE_CHUNK_SIZE)
+
+# Every client is put in this room when it connects
+DEFAULT_ROOM = 'general'
+MAX_ROOM_NAME = 32
+# Longest chat or direct message relayed, in bytes, so the prefixed copies stay far below MAX_FRAME_SIZE
+MAX_MESSAGE_BYTES = 64 * 1024
+# Most messages a single /history request returns
+MAX_HISTORY_REPLAY = 500
+# A history replay is split into messages of about this many bytes
+HISTORY_CHUNK_BYTES = 64 * 1024
+PING_FRAME = encode_frame(PING, b'')
+# Chunks a file sender may have in flight, also the backlog per recipient at which it has to wait
+FILE_WINDOW = 4
+
+
+def create_host_key(path=None):
+    """The server's RSA key: persisted in path when given, otherwise a throwaway one for this run"""
+    if path:
+        return load_host_key(path)
+    return rsa.generate_private_key(
+        public_exponent=65537,
+        key_size=2048,
+        backend=default_backend()
+    )
+
+
+def load_host_key(path):
+    """Load the server's RSA key from path, generating and saving it on first use.
+
+    A persisted key makes restarts fast (no RSA key generation) and keeps the
+    key clients see stable across deploys.
+    """
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            # The file is our own output, skipping the RSA consistency checks
+            # saves ~60 ms of start-up
+            return serialization.load_pem_private_key(
+                f.read(),
+                password=None,
+                backend=default_backend(),
+                unsafe_skip_rsa_key_validation=True
+            )
+
+    private_key = rsa.generate_private_key(
+        public_exponent=65537,
+        key_size=2048,
+        backend=default_backend()
+    )
+    private_key_pem = private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()
+    )
+    # Readable by the server's user only
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(private_key_pem)
+    print(f"Generated new host key in {path}")
+    return private_key
+
+
+# Private key of a handshake process pool worker, see init_handshake_worker
+worker_private_key = None
+
+
+def init_handshake_worker(private_key_pem):
+    global worker_private_key
+    worker_private_key = serialization.load_pem_private_key(
+        private_key_pem,
+        password=None,
+        backend=default_backend(),
+        # Exported by the parent process from a key it already validated
+        unsafe_skip_rsa_key_validation=True
+    )
+
+
+def decrypt_session_secret(wrapped_secret, private_key=None):
+    """Unwrap the client's session key and IV with a single RSA-OAEP decrypt.
+
+    Runs on the handshake pool. Process pool workers pass no key and use the
+    one loaded by init_handshake_worker.
+    """
+    secret = (private_key or worker_private_key).decrypt(
+        wrapped_secret,
+        padding.OAEP(
+            mgf=padding.MGF1(algorithm=hashes.SHA256()),
+            algorithm=hashes.SHA256(),
+            label=None
+        )
+    )
+    if len(secret) != 48:
+        raise ValueError(f"Expected 48 bytes of session key and IV, got {len(secret)}")
+    return secret[:32], secret[32:]
+
+
+class HandshakeStats:
+    """Counts completed handshakes and reports handshakes/sec periodically"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total_time = 0.0
+
+    def record(self, duration):
+        with self.lock:
+            self.count += 1
+            self.total_time += duration
+
+    def take(self):
+        """Return (count, total seconds) since the last call and reset them"""
+        with self.lock:
+            count, total_time = self.count, self.total_time
+            self.count, self.total_time = 0, 0.0
+        return count, total_time
+
+    def report_forever(self, interval):
+        while True:
+            time.sleep(interval)
+            count, total_time = self.take()
+            if count:
+                log(f"Handshakes: {count / interval:.1f}/s, average {total_time / count * 1000:.1f} ms")
+
+
+class TicketIssuer:
+    """Session resumption tickets sealed with a server-side AES-GCM key.
+
+    A ticket carries everything needed to resume without server-side state:
+    expiry, a fresh resumption secret, the username and the client's public
+    key (DER, for group key wrapping). The client gets the ticket together with
+    the resumption secret over its encrypted session and presents the ticket
+    on reconnect; both sides then derive the new session key from the secret
+    and a nonce from each side, with no RSA operations.
+    """
+
+    def __init__(self, lifetime=3600, key=None):
+        self.lifetime = lifetime
+        self.aead = AESGCM(key or AESGCM.generate_key(bit_length=256))
+
+    def issue(self, username, client_public_key):
+        """Return (resumption secret, ticket)"""
+        secret = os.urandom(32)
+        username_bytes = username.encode('utf-8')
+        public_key_der = client_public_key.public_bytes(
+            encoding=serialization.Encoding.DER,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        plaintext = (int(time.time() + self.lifetime).to_bytes(8, byteorder='big') + secret +
+                     len(username_bytes).to_bytes(2, byteorder='big') + username_bytes + public_key_der)
+        nonce = os.urandom(12)
+        return secret, nonce + self.aead.encrypt(nonce, plaintext, None)
+
+    def redeem(self, ticket):
+        """Return (username, resumption secret, client public key), or None if the ticket is invalid or expired"""
+        try:
+            plaintext = self.aead.decrypt(ticket[:12], ticket[12:], None)
+        except Exception:
+            return None
+        if int.from_bytes(plaintext[:8], byteorder='big') < time.time():
+            return None
+        secret = plaintext[8:40]
+        username_len = int.from_bytes(plaintext[40:42], byteorder='big')
+        username = plaintext[42:42 + username_len].decode('utf-8')
+        client_public_key = serialization.load_der_public_key(
+            plaintext[42 + username_len:],
+            backend=default_backend()
+        )
+        return username, secret, client_public_key
+
+
+class ClientOutbox:
+    """Bounded queue of outgoing data for one client, drained by its own writer thread.
+
+    Senders only append to the queue, so a stalled peer can never block a
+    broadcast. When the queue grows past max_bytes (or its oldest entry is
+    older than max_delay seconds) the slow-consumer policy applies: with
+    'drop-oldest' the oldest queued items are discarded, with 'disconnect'
+    the client is closed. Room key and ticket frames are never dropped, the
+    session cannot do without them; they still count against max_bytes and
+    a client they alone fill the queue for is closed too.
+
+    Queued str items are chat messages that still have to be encrypted for this
+    client; seal turns them into wire bytes in the writer, right before they
+    are sent, so the client's cipher stream only ever covers data that really
+    goes out. Queued bytes are sent as they are.
+
+    File transfer frames go to a separate bulk queue (put_bulk). It is exempt
+    from the slow-consumer policy, the transfer's credits bound it instead,
+    and each write carries at most BULK_BYTES of it behind the chat messages,
+    so text never waits for more than a chunk or two of a file. when_below
+    tells a transfer when the bulk backlog has drained.
+
+    The writer takes everything queued at once and sends it with a single
+    sendmsg call. With flush_delay it first waits up to that many seconds
+    after the oldest queued message for more to arrive, trading latency for
+    fewer, larger writes during bursts.
+    """
+
+    # A batch is sent early once it holds this many bytes
+    FLUSH_BYTES = 64 * 1024
+    # Most bulk data added to one write
+    BULK_BYTES = 64 * 1024
+
+    def __init__(self, sock, seal=None, max_bytes=1024 * 1024, max_delay=0, policy='drop-oldest',
+                 flush_delay=0, metrics=None):
+        self.sock = sock
+        self.metrics = metrics
+        self.seal = seal
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.policy = policy
+        self.flush_delay = flush_delay
+        self.queue = deque()  # (enqueue time, data) pairs
+        self.queued_bytes = 0
+        self.bulk = deque()
+        self.bulk_bytes = 0
+        self.drain_waiters = []  # (limit, callback) registered with when_below
+        self.dropped = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def admit(self, data):
+        """Apply the slow-consumer policy and queue data, returns False if the client must go"""
+        now = time.monotonic()
+        over_size = self.queued_bytes + len(data) > self.max_bytes
+        over_delay = self.max_delay and self.queue and now - self.queue[0][0] > self.max_delay
+
+        if over_size or over_delay:
+            if self.policy == 'disconnect':
+                return False
+            kept = deque()
+            while self.queue and (self.queued_bytes + len(data) > self.max_bytes or
+                                  (self.max_delay and now - self.queue[0][0] > self.max_delay)):
+                entry = self.queue.popleft()
+                if isinstance(entry[1], bytes) and entry[1][4] in (GROUP_KEY, TICKET):
+                    # Losing a room key or the pre-encrypted ticket breaks the session
+                    kept.append(entry)
+                    continue
+                self.queued_bytes -= len(entry[1])
+                self.dropped += 1
+                if self.metrics:
+                    self.metrics.dropped.inc()
+            if kept:
+                kept.extend(self.queue)
+                self.queue = kept
+            if self.queued_bytes + len(data) > self.max_bytes:
+                return False
+
+        self.queue.append((now, data))
+        self.queued_bytes += len(data)
+        return True
+
+    def put(self, data):
+        with self.cond:
+            if self.closed:
+                return False
+            if self.admit(data):
+                self.cond.notify()
+                return True
+        self.close()
+        return False
+
+    def put_bulk(self, data):
+        with self.cond:
+            if self.closed:
+                return False
+            self.bulk.append(data)
+            self.bulk_bytes += len(data)
+            self.cond.notify()
+            return True
+
+    def when_below(self, limit, callback):
+        """Call callback once fewer than limit bytes of bulk data are waiting, or the outbox is closed"""
+        with self.cond:
+            if not self.closed and self.bulk_bytes >= limit:
+                self.drain_waiters.append((limit, callback))
+                return
+        callback()
+
+    def drained(self):
+        """Remove and return the callbacks of the waiters whose limit has been reached"""
+        ready = [(limit, callback) for limit, callback in self.drain_waiters
+                 if self.closed or self.bulk_bytes < limit]
+        if ready:
+            self.drain_waiters = [waiter for waiter in self.drain_waiters if waiter not in ready]
+        return [callback for _, callback in ready]
+
+    def close(self):
+        with self.cond:
+            self.close_locked()
+            ready = self.drained()
+        for callback in ready:
+            callback()
+
+    def close_locked(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.clear()
+        self.queued_bytes = 0
+        self.bulk.clear()
+        self.bulk_bytes = 0
+        self.cond.notify()
+        # Wake up the reader thread blocked in recv so the client gets cleaned up
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def take_batch(self):
+        """Dequeue the next batch of queued items, in order, then up to BULK_BYTES of bulk data"""
+        batch = []
+        while self.queue and len(batch) < MAX_IOVECS:
+            _, data = self.queue.popleft()
+            self.queued_bytes -= len(data)
+            batch.append(data)
+        bulk_bytes = 0
+        while self.bulk and len(batch) < MAX_IOVECS and bulk_bytes < self.BULK_BYTES:
+            data = self.bulk.popleft()
+            self.bulk_bytes -= len(data)
+            bulk_bytes += len(data)
+            batch.append(data)
+        return batch
+
+    def flush_deadline(self):
+        return self.queue[0][0] + self.flush_delay
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.bulk and not self.closed:
+                    self.cond.wait()
+                while self.flush_delay and self.queue and not self.closed and self.queued_bytes < self.FLUSH_BYTES:
+                    remaining = self.flush_deadline() - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                if self.closed:
+                    return
+                batch = self.take_batch()
+
+            try:
+                buffers = [data if isinstance(data, bytes) else self.seal(data) for data in batch]
+                send_buffers(self.sock, buffers)
+            except OSError:
+                self.close()
+                return
+            self.count_write(buffers)
+            if self.drain_waiters:
+                with self.cond:
+                    ready = self.drained()
+                for callback in ready:
+                    callback()
+
+    def count_write(self, buffers):
+        if self.metrics:
+            self.metrics.writes.inc()
+            self.metrics.bytes_out.inc(sum(len(data) for data in buffers))
+
+
+class AsyncClientOutbox(ClientOutbox):
+    """ClientOutbox drained by an asyncio task instead of a thread"""
+
+    def __init__(self, sock, seal=None, max_bytes=1024 * 1024, max_delay=0, policy='drop-oldest',
+                 flush_delay=0, metrics=None):
+        super().__init__(sock, seal, max_bytes, max_delay, policy, flush_delay, metrics)
+        self.ready = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def put(self, data):
+        # Only ever called from the event loop thread, no locking needed
+        if self.closed:
+            return False
+        if not self.admit(data):
+            self.close()
+            return False
+        self.ready.set()
+        return True
+
+    def put_bulk(self, data):
+        if self.closed:
+            return False
+        self.bulk.append(data)
+        self.bulk_bytes += len(data)
+        self.ready.set()
+        return True
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.clear()
+        self.queued_bytes = 0
+        self.bulk.clear()
+        self.bulk_bytes = 0
+        self.ready.set()
+        # Stop a pending sock_sendall before the socket gets closed under it
+        if self.task and self.task is not asyncio.current_task():
+            self.task.cancel()
+        # Wake up the reader task waiting in sock_recv_into
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        for callback in self.drained():
+            callback()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                while not self.queue and not self.bulk:
+                    if self.closed:
+                        return
+                    self.ready.clear()
+                    await self.ready.wait()
+                if self.flush_delay and self.queue and self.queued_bytes < self.FLUSH_BYTES:
+                    remaining = self.flush_deadline() - time.monotonic()
+                    if remaining > 0:
+                        await asyncio.sleep(remaining)
+                    if self.closed:
+                        return
+                batch = self.take_batch()
+                # Only waits when the socket buffer is full, i.e. for this client alone
+                buffers = [data if isinstance(data, bytes) else self.seal(data) for data in batch]
+                await send_buffers_async(loop, self.sock, buffers)
+                self.count_write(buffers)
+                for callback in self.drained():
+                    callback()
+        except (ConnectionError, OSError):
+            self.close()
+
+
+class GroupKey:
+    """Symmetric key shared by every member of a room.
+
+    Broadcasts are encrypted once with this key and the same ciphertext is
+    queued for every member. Each member receives the key wrapped with the RSA
+    public key it sent during the handshake, and the key is replaced whenever
+    membership changes so departed users cannot read new messages.
+
+    Keys are (epoch, key) pairs. The one in use is kept in the room's
+    snapshot next to the members who have it, not here.
+    """
+
+    # Epochs are unique across rooms, so clients can find the key by epoch alone
+    epochs = itertools.count(1)
+
+    def __init__(self, room_name):
+        self.room_name = room_name
+
+    def new_key(self):
+        return next(GroupKey.epochs) % (1 << 32), os.urandom(32)
+
+    def wrap_for(self, public_key, current):
+        """GROUP_KEY frame for one member: epoch + room name length + room name + RSA-OAEP(key)"""
+        epoch, key = current
+        wrapped_key = public_key.encrypt(
+            key,
+            padding.OAEP(
+                mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                algorithm=hashes.SHA256(),
+                label=None
+            )
+        )
+        room_name = self.room_name.encode('utf-8')
+        payload = epoch.to_bytes(4, byteorder='big') + bytes([len(room_name)]) + room_name + wrapped_key
+        return encode_frame(GROUP_KEY, payload)
+
+    def encrypt_message(self, message, current):
+        """GROUP_MESSAGE frame: epoch + nonce + AES-CTR ciphertext"""
+        epoch, key = current
+        nonce = os.urandom(16)
+        encryptor = Cipher(
+            algorithms.AES(key),
+            modes.CTR(nonce),
+            backend=default_backend()
+        ).encryptor()
+
+        encrypted_data = encryptor.update(message.encode('utf-8')) + encryptor.finalize()
+        payload = epoch.to_bytes(4, byteorder='big') + nonce + encrypted_data
+        return encode_frame(GROUP_MESSAGE, payload)
+
+
+class Room:
+    """A named channel: its members and, in group key mode, its GroupKey.
+
+    members maps usernames to ClientRecords, away is the frozenset of users
+    who dropped recently and whose mailboxes collect the room's messages.
+    They are published together with the group key in use as one
+    (members, key, away) snapshot, which is never changed in place:
+    ChatServer.set_members and set_away (under the server lock) build a new
+    one and swap it in, so a broadcast reads all three at once without
+    locking, never pairs a member with a key that member was not sent and
+    never misses a user moving between members and away. A room lasts while
+    it has members or away users.
+    """
+
+    def __init__(self, name, group_key_mode=False):
+        self.name = name
+        self.group_key = GroupKey(name) if group_key_mode else None
+        self.snapshot = ({}, None, frozenset())
+
+    @property
+    def members(self):
+        return self.snapshot[0]
+
+    @property
+    def away(self):
+        return self.snapshot[2]
+
+
+class ClientRecord:
+    """What the server keeps for one connection, shared by the registry and the rooms"""
+    __slots__ = ('username', 'outbox', 'session', 'compression', 'public_key', 'bucket', 'transfers',
+                 'taken_over')
+
+    def __init__(self, session, public_key):
+        self.username = None
+        self.outbox = None
+        self.session = session
+        self.compression = None
+        self.public_key = public_key  # for wrapping group keys
+        self.bucket = None            # TokenBucket for the frames the user sends
+        self.transfers = {}           # the user's transfer id -> Transfer of the files they are sending
+        self.taken_over = False       # a resumed session has the username now
+
+
+class ConnectionWatch:
+    """Handshake deadline and idle timeout of one connection, kept on the server's timer wheel.
+
+    Received frames only record the time in touch(); the timer compares
+    against it when it fires and schedules itself again for the rest of the
+    period, so busy connections never touch the wheel. An idle client is sent
+    a PING halfway through the idle timeout and is closed if the whole
+    timeout passes without a frame from it.
+    """
+
+    def __init__(self, server, sock, address):
+        self.server = server
+        self.sock = sock
+        self.address = address
+        self.outbox = None  # set once the handshake is complete
+        self.last_activity = time.monotonic()
+        self.pinged = False
+        self.closed = False
+        self.timer = None
+        if server.handshake_timeout:
+            self.timer = server.timers.schedule(server.handshake_timeout, self.handshake_expired)
+
+    def touch(self):
+        self.last_activity = time.monotonic()
+        self.pinged = False
+
+    def handshake_done(self, outbox):
+        self.outbox = outbox
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        self.touch()
+        if self.server.idle_timeout:
+            self.timer = self.server.timers.schedule(self.server.idle_timeout / 2, self.check_idle)
+
+    def handshake_expired(self):
+        if not self.closed and self.outbox is None:
+            self.drop('handshake')
+
+    def check_idle(self):
+        if self.closed:
+            return
+        timeout = self.server.idle_timeout
+        idle = time.monotonic() - self.last_activity
+        if idle >= timeout:
+            self.drop('idle')
+            return
+        if idle >= timeout / 2 and not self.pinged:
+            self.pinged = True
+            self.outbox.put(PING_FRAME)
+        # Look again at the ping point, or at the deadline once the ping is out
+        self.timer = self.server.timers.schedule((timeout if self.pinged else timeout / 2) - idle, self.check_idle)
+
+    def drop(self, stage):
+        log(f"Closing {self.address[0]}:{self.address[1]}, {stage} timeout")
+        self.server.metrics.timeouts[stage].inc()
+        # Wakes up the reader blocked in recv, which cleans up the client
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        self.closed = True
+        if self.timer:
+            self.timer.cancel()
 
 
 class ChatServer:
-    def __init__(self, host='0.0.0.0', port=8000):
+    def __init__(self, host='0.0.0.0', port=8000, max_queued_bytes=1024 * 1024,
+                 max_queue_delay=0, slow_consumer='drop-oldest', group_key=False,
+                 handshake_pool='thread', handshake_workers=None, stats_interval=10,
+                 ticket_lifetime=3600, host_key_path=None, benchmark_startup=False,
+                 private_key=None, ticket_key=None, reuse_port=False, history_dir=None,
+                 history_replay=20, history_segment_bytes=16 * 1024 * 1024, history_segments=8,
+                 flush_delay=0, metrics_port=0, compression=True, compression_threshold=32,
+                 backlog=1024, max_connections=0, handshake_timeout=10, idle_timeout=300,
+                 rate_limit=10, rate_burst=30, offline_hold=120, offline_max_messages=1000, offline_dir=None,
+                 max_file_size=100 * 1024 * 1024):
         self.host = host
         self.port = port
+        self.max_queued_bytes = max_queued_bytes
+        self.max_queue_delay = max_queue_delay
+        self.slow_consumer = slow_consumer
+        self.flush_delay = flush_delay
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.open_connections = 0
+        self.handshake_timeout = handshake_timeout
+        self.idle_timeout = idle_timeout
+        self.timers = TimerWheel()
+        self.rate_limit = rate_limit
+        self.rate_burst = rate_burst
+        self.offline_hold = offline_hold
+        self.offline_max_messages = offline_max_messages
+        self.mailboxes = {}  # username -> Mailbox, while connected and for offline_hold seconds after
+        self.offline_store = OfflineStore(offline_dir) if offline_dir and offline_hold else None
+        self.max_file_size = max_file_size
+        self.transfer_ids = itertools.count(1)
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # Lets every worker process of a cluster accept on the same port
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_socket.bind((self.host, self.port))
-        self.clients = {}  # Maps usernames to (socket, encryption_info) tuples
-        self.lock = threading.Lock()
+        # username -> ClientRecord. Like Room.members it is replaced, never
+        # changed in place, and only under self.lock, so the message path reads
+        # it without locking
+        self.clients = {}
+        self.usernames = set()  # Claimed usernames, including clients still finishing their handshake
+        self.bus = None  # cluster.BusClient when running as one of several worker processes
+        # Guards joins, leaves and the registry; reentrant because a join's
+        # broadcast may remove a failed client
+        self.lock = threading.RLock()
         self.ngrok_url = None
+        self.group_key_mode = group_key
+        self.rooms = {}         # room name -> Room
+        self.user_rooms = {}    # username -> names of the rooms the user is in
+        self.active_rooms = {}  # username -> room the user's messages go to
+        self.history = MessageLog(history_dir, history_segment_bytes, history_segments) if history_dir else None
+        self.history_replay = history_replay
+        self.metrics = ServerMetrics(self)
+        if self.offline_store:
+            for username, mailbox in self.offline_store.load(offline_max_messages).items():
+                self.mailboxes[username] = mailbox
+                self.hold_mailbox(username, mailbox)
+        self.admin = None
+        if metrics_port:
+            # Imported here, http.server is slow to load and only needed with an admin port
+            from admin import AdminServer
+            self.admin = AdminServer(self.metrics, metrics_port)
+        self.benchmark_startup = benchmark_startup
 
-        # Generate server's key pair
-        self.private_key = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=2048,
-            backend=default_backend()
-        )
+        self.private_key = private_key or create_host_key(host_key_path)
         self.public_key = self.private_key.public_key()
         self.public_key_pem = self.public_key.public_bytes(
             encoding=serialization.Encoding.PEM,
             format=serialization.PublicFormat.SubjectPublicKeyInfo
         )
 
+        # RSA work of the handshake runs on a bounded pool so reconnect storms
+        # queue up there instead of starving the accept and message paths
+        self.handshake_pool_kind = handshake_pool
+        self.handshake_pool = self.create_handshake_pool(handshake_pool, handshake_workers)
+        self.handshake_stats = HandshakeStats()
+        self.tickets = TicketIssuer(ticket_lifetime, ticket_key) if ticket_lifetime else None
+        if stats_interval:
+            threading.Thread(target=self.handshake_stats.report_forever, args=(stats_interval,), daemon=True).start()
+
+    def create_handshake_pool(self, kind, workers):
+        workers = workers or os.cpu_count() or 1
+        if kind == 'process':
+            private_key_pem = self.private_key.private_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PrivateFormat.PKCS8,
+                encryption_algorithm=serialization.NoEncryption()
+            )
+            return ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=init_handshake_worker,
+                initargs=(private_key_pem,)
+            )
+        if kind == 'thread':
+            return ThreadPoolExecutor(max_workers=workers, thread_name_prefix='handshake')
+        return None
+
+    def submit_session_secret(self, wrapped_secret):
+        """Start unwrapping the session key and IV on the handshake pool, returns a Future"""
+        if self.handshake_pool_kind == 'process':
+            return self.handshake_pool.submit(decrypt_session_secret, wrapped_secret)
+        return self.handshake_pool.submit(decrypt_session_secret, wrapped_secret, self.private_key)
+
+    def unwrap_session_secret(self, wrapped_secret):
+        try:
+            with self.metrics.unwrap.time():
+                if self.handshake_pool is None:
+                    return decrypt_session_secret(wrapped_secret, self.private_key)
+                return self.submit_session_secret(wrapped_secret).result()
+        except Exception as e:
+            log(f"Failed to decrypt session key/IV: {e}")
+            raise
+
+    async def unwrap_session_secret_async(self, wrapped_secret):
+        try:
+            with self.metrics.unwrap.time():
+                if self.handshake_pool is None:
+                    return decrypt_session_secret(wrapped_secret, self.private_key)
+                return await asyncio.wrap_future(self.submit_session_secret(wrapped_secret))
+        except Exception as e:
+            log(f"Failed to decrypt session key/IV: {e}")
+            raise
+
     def start(self):
-        self.server_socket.listen(5)
+        self.server_socket.listen(self.backlog)
         print(f"Encrypted server started on {self.host}:{self.port}")
-        print(f"Local IP: {self.get_local_ip()}")
+        print(f"Host key fingerprint: {self.host_key_fingerprint()}")
 
-        # Check for ngrok tunnel
-        self.ngrok_url = self.get_ngrok_url()
-        if self.ngrok_url:
-            print(f"ngrok tunnel established: {self.ngrok_url}")
-            print(f"For clients to connect, use: connect username {self.ngrok_url.split('//')[1]}")
+        if self.benchmark_startup:
+            probe = socket.create_connection((self.probe_host(), self.port))
+            self.server_socket.accept()[0].close()
+            probe.close()
+            self.report_startup()
+            self.server_socket.close()
+            return
+
+        # Address discovery is slow and not needed to serve, do it after the listener is up
+        threading.Thread(target=self.announce, daemon=True).start()
+        threading.Thread(target=self.timers.run_forever, daemon=True).start()
+        if self.bus:
+            self.bus.start()
+        self.start_admin()
 
         try:
             while True:
                 client_socket, address = self.server_socket.accept()
-                print(f"New connection from {address[0]}:{address[1]}")
+                self.metrics.connections.inc()
+                if not self.admit_connection(client_socket, address):
+                    continue
+                log(f"New connection from {address[0]}:{address[1]}")
                 threading.Thread(target=self.handle_client, args=(client_socket, address)).start()
         except KeyboardInterrupt:
             print("Server shutting down...")
         finally:
             self.server_socket.close()
+            if self.history:
+                self.history.close()
+            if self.offline_store:
+                self.offline_store.close()
+            flush_log()
 
-    def encrypt_message(self, message, session_key, iv):
-        encryptor = Cipher(
-            algorithms.AES(session_key),
-            modes.CFB(iv),
-            backend=default_backend()
-        ).encryptor()
+    def admit_connection(self, client_socket, address):
+        """Count a new connection against max_connections, closing it if the server is full"""
+        with self.lock:
+            if not self.max_connections or self.open_connections < self.max_connections:
+                self.open_connections += 1
+                return True
+        log(f"Refused {address[0]}:{address[1]}, {self.max_connections} connections open")
+        self.metrics.refused.inc()
+        client_socket.close()
+        return False
 
-        encrypted_data = encryptor.update(message.encode('utf-8')) + encryptor.finalize()
-        return base64.b64encode(encrypted_data).decode('utf-8')
+    def release_connection(self):
+        with self.lock:
+            self.open_connections -= 1
 
-    def decrypt_message(self, encrypted_message, session_key, iv):
-        encrypted_data = base64.b64decode(encrypted_message.encode('utf-8'))
-        decryptor = Cipher(
-            algorithms.AES(session_key),
-            modes.CFB(iv),
-            backend=default_backend()
-        ).decryptor()
+    def start_admin(self):
+        if self.admin:
+            self.admin.start()
+            print(f"Metrics on http://127.0.0.1:{self.admin.httpd.server_port}/metrics")
+
+    def announce(self):
+        """Print the addresses clients can use to reach the server"""
+        log(f"Local IP: {self.get_local_ip()}")
+
+        # Check for ngrok tunnel
+        self.ngrok_url = self.get_ngrok_url()
+        if self.ngrok_url:
+            log(f"ngrok tunnel established: {self.ngrok_url}")
+            log(f"For clients to connect, use: connect username {self.ngrok_url.split('//')[1]}")
+
+    def host_key_fingerprint(self):
+        public_key_der = self.public_key.public_bytes(
+            encoding=serialization.Encoding.DER,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        return 'SHA256:' + hashlib.sha256(public_key_der).hexdigest()
+
+    def probe_host(self):
+        return '127.0.0.1' if self.host == '0.0.0.0' else self.host
 
-        decrypted_data = decryptor.update(encrypted_data) + decryptor.finalize()
-        return decrypted_data.decode('utf-8')
+    def report_startup(self):
+        print(f"Startup: {(time.perf_counter() - PROCESS_START) * 1000:.1f} ms from process start to first accept")
+
+    def encrypt_message(self, message, session, compression=None, sequence=b''):
+        """MESSAGE frame carrying message encrypted with the client's session stream,
+        compressed first when the client negotiated compression"""
+        data = message.encode('utf-8')
+        flags = SEQUENCED if sequence else 0
+        if compression:
+            size = len(data)
+            data, compressed = compression.compress(data)
+            if compressed:
+                flags |= COMPRESSED
+                self.metrics.compress_in.inc(size)
+                self.metrics.compress_out.inc(len(data))
+        with self.metrics.encrypt.time():
+            return encode_frame(MESSAGE, sequence + session.encrypt(data, MESSAGE, flags, sequence), flags)
+
+    def seal(self, item, session, compression):
+        """Wire bytes for an outbox item that is chat text, a Sequenced text or group frame or a FileFrame"""
+        if isinstance(item, FileFrame):
+            # Continues the session stream like chat text, without compression
+            with self.metrics.encrypt.time():
+                return encode_frame(item.frame_type, session.encrypt(item.data, item.frame_type))
+        if not isinstance(item, Sequenced):
+            return self.encrypt_message(item, session, compression)
+        sequence = SEQUENCE.pack(item.mailbox, item.seq)
+        if isinstance(item.message, str):
+            return self.encrypt_message(item.message, session, compression, sequence)
+        # A GROUP_MESSAGE frame shared by the room, the sequence goes in front of its payload
+        return encode_frame(GROUP_MESSAGE, sequence + item.message[HEADER.size:], SEQUENCED)
+
+    def decrypt_data(self, frame_type, encrypted_data, session, compression=None, flags=0):
+        with self.metrics.decrypt.time():
+            data = session.decrypt(encrypted_data, frame_type, flags)
+        if flags & COMPRESSED:
+            if compression is None:
+                raise ConnectionError("Compressed frame on a connection without compression")
+            data = compression.decompress(data)
+        return data
+
+    def negotiate_compression(self, username_flags):
+        """Compression streams for a client that took our offer, None if either side does without"""
+        if self.compression and username_flags & COMPRESSED:
+            return StreamCompression(self.compression_threshold)
+        return None
+
+    def load_client_public_key(self, client_public_key_pem):
+        try:
+            return serialization.load_pem_public_key(
+                client_public_key_pem,
+                backend=default_backend()
+            )
+        except Exception as e:
+            log(f"Failed to load client's public key: {e}")
+            log(f"Received data: {client_public_key_pem[:100]}...")
+            raise
+
+    def decrypt_username(self, username_frame, session):
+        """The USERNAME frame's text, never compressed: its COMPRESSED flag takes up the server's offer"""
+        encrypted_username = expect_frame(username_frame, USERNAME)
+        with self.metrics.decrypt.time():
+            return session.decrypt(encrypted_username, USERNAME, username_frame[1]).decode('utf-8')
+
+    def complete_handshake(self, client_public_key_pem, session_secret, username_frame):
+        """Turn the client's handshake frames into (username, ClientRecord)"""
+        client_public_key = self.load_client_public_key(client_public_key_pem)
+
+        session_key, iv = session_secret
+        session = CryptoSession(session_key, iv, is_server=True)
+        username = self.decrypt_username(username_frame, session)
+        return username, ClientRecord(session, client_public_key)
+
+    def try_resume(self, resume_payload):
+        """Check a RESUME frame, returns (server nonce, username, ClientRecord) or None"""
+        if not self.tickets:
+            return None
+        client_nonce, ticket = bytes(resume_payload[:16]), bytes(resume_payload[16:])
+        redeemed = self.tickets.redeem(ticket)
+        if redeemed is None:
+            return None
+        username, resumption_secret, client_public_key = redeemed
+
+        server_nonce = os.urandom(16)
+        session_key, iv = derive_resumed_secret(resumption_secret, client_nonce, server_nonce)
+        return server_nonce, username, ClientRecord(CryptoSession(session_key, iv, is_server=True), client_public_key)
+
+    def complete_resume(self, resumed, username_frame):
+        """The client proves it derived the same keys by sending the ticket's username"""
+        _, ticket_username, client = resumed
+        username = self.decrypt_username(username_frame, client.session)
+        if username != ticket_username:
+            raise ConnectionError("Resumed session does not match the ticket")
+        return username, client
+
+    def ticket_frame(self, username, client):
+        """TICKET frame for the client's next reconnect, None when resumption is disabled.
+
+        It is encrypted with the session stream, so it has to be sent before the
+        client's outbox starts writing.
+        """
+        if not self.tickets:
+            return None
+        secret, ticket = self.tickets.issue(username, client.public_key)
+        return encode_frame(TICKET, client.session.encrypt(secret + ticket, TICKET))
 
     def handle_client(self, client_socket, address):
         username = None
-        client_public_key = None
-        session_key = None
-        iv = None
+        claimed = False
+        outbox = None
+        decoder = FrameDecoder()
+        handshake_start = time.monotonic()
+        watch = ConnectionWatch(self, client_socket, address)
 
         try:
-            # STEP 1: Send server's public key with proper framing
-            public_key_pem = self.public_key.public_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PublicFormat.SubjectPublicKeyInfo
-            )
-            client_socket.send(len(public_key_pem).to_bytes(4, byteorder='big'))
-            client_socket.send(public_key_pem)
-
-            # STEP 2: Receive client's public key with proper framing
-            key_size_bytes = client_socket.recv(4)
-            key_size = int.from_bytes(key_size_bytes, byteorder='big')
-
-            client_public_key_pem = b''
-            remaining = key_size
-            while remaining > 0:
-                chunk = client_socket.recv(min(remaining, 4096))
-                if not chunk:
-                    raise ConnectionError("Connection closed during key exchange")
-                client_public_key_pem += chunk
-                remaining -= len(chunk)
-
-            # Load the client's public key
-            try:
-                client_public_key = serialization.load_pem_public_key(
-                    client_public_key_pem,
-                    backend=default_backend()
-                )
-            except Exception as e:
-                print(f"Failed to load client's public key: {e}")
-                print(f"Received data: {client_public_key_pem[:100]}...")
-                raise
-
-            # STEP 3: Receive encrypted session key with proper framing
-            key_size_bytes = client_socket.recv(4)
-            key_size = int.from_bytes(key_size_bytes, byteorder='big')
-
-            encrypted_session_key = b''
-            remaining = key_size
-            while remaining > 0:
-                chunk = client_socket.recv(min(remaining, 4096))
-                if not chunk:
-                    raise ConnectionError("Connection closed during key exchange")
-                encrypted_session_key += chunk
-                remaining -= len(chunk)
-
-            # Receive encrypted IV
-            iv_size_bytes = client_socket.recv(4)
-            iv_size = int.from_bytes(iv_size_bytes, byteorder='big')
-
-            encrypted_iv = b''
-            remaining = iv_size
-            while remaining > 0:
-                chunk = client_socket.recv(min(remaining, 4096))
-                if not chunk:
-                    raise ConnectionError("Connection closed during key exchange")
-                encrypted_iv += chunk
-                remaining -= len(chunk)
-
-            # Decrypt session key and IV with server's private key
-            try:
-                session_key = self.private_key.decrypt(
-                    encrypted_session_key,
-                    padding.OAEP(
-                        mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                        algorithm=hashes.SHA256(),
-                        label=None
-                    )
-                )
+            # The outbox writes whole batches of frames, Nagle would only hold them back
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            # STEP 1: Send server's public key
+            client_socket.sendall(encode_frame(PUBLIC_KEY, self.public_key_pem, COMPRESSED if self.compression else 0))
+
+            # STEP 2: The client either resumes with a ticket or starts a full handshake
+            frame = read_frame(client_socket, decoder)
+            resumed = None
+            if frame is not None and frame[0] == RESUME:
+                resumed = self.try_resume(frame[2])
+                if resumed:
+                    client_socket.sendall(encode_frame(RESUME_OK, resumed[0]))
+                else:
+                    client_socket.sendall(encode_frame(RESUME_FAILED, b''))
+                    frame = read_frame(client_socket, decoder)
+
+            if resumed:
+                username_frame = read_frame(client_socket, decoder)
+                username, client = self.complete_resume(resumed, username_frame)
+            else:
+                # STEP 2-4: Receive client's public key, wrapped session key and IV, encrypted username
+                client_public_key_pem = expect_frame(frame, PUBLIC_KEY)
+                wrapped_secret = expect_frame(read_frame(client_socket, decoder), SESSION_KEY)
+                username_frame = read_frame(client_socket, decoder)
 
-                iv = self.private_key.decrypt(
-                    encrypted_iv,
-                    padding.OAEP(
-                        mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                        algorithm=hashes.SHA256(),
-                        label=None
-                    )
+                username, client = self.complete_handshake(
+                    client_public_key_pem, self.unwrap_session_secret(wrapped_secret), username_frame
                 )
-            except Exception as e:
-                print(f"Failed to decrypt session key/IV: {e}")
-                raise
-
-            # STEP 4: Receive encrypted username with proper framing
-            username_size_bytes = client_socket.recv(4)
-            username_size = int.from_bytes(username_size_bytes, byteorder='big')
-
-            encrypted_username_bytes = b''
-            remaining = username_size
-            while remaining > 0:
-                chunk = client_socket.recv(min(remaining, 4096))
-                if not chunk:
-                    raise ConnectionError("Connection closed during username exchange")
-                encrypted_username_bytes += chunk
-                remaining -= len(chunk)
-
-            encrypted_username = encrypted_username_bytes.decode('utf-8')
-            username = self.decrypt_message(encrypted_username, session_key, iv)
-
-            print(f"User {username} connected from {address[0]}:{address[1]} (encrypted)")
-
-            # Store client info
-            encryption_info = {
-                'public_key': client_public_key,
-                'session_key': session_key,
-                'iv': iv
-            }
+            session = client.session
+            compression = client.compression = self.negotiate_compression(username_frame[1])
+            self.handshake_stats.record(time.monotonic() - handshake_start)
+            self.metrics.handshakes.observe(time.monotonic() - handshake_start)
 
-            with self.lock:
-                self.clients[username] = (client_socket, encryption_info)
-                self.broadcast(f"{username} has joined the chat!")
+            if not self.claim_username(username) and not (resumed and self.take_over(username)):
+                client_socket.sendall(self.encrypt_message(f"Username {username} is already taken.", session))
+                log(f"Rejected {address[0]}:{address[1]}, username {username} is already taken")
+                return
+            claimed = True
 
-            # Also need to modify the message receiving loop to use proper framing
-            while True:
-                # Receive message size
-                size_bytes = client_socket.recv(4)
-                if not size_bytes:
-                    break
+            ticket = self.ticket_frame(username, client)
 
-                msg_size = int.from_bytes(size_bytes, byteorder='big')
+            log(f"User {username} {'resumed' if resumed else 'connected'} from {address[0]}:{address[1]} (encrypted)")
 
-                # Receive full message
-                encrypted_message_bytes = b''
-                remaining = msg_size
-                while remaining > 0:
-                    chunk = client_socket.recv(min(remaining, 4096))
-                    if not chunk:
-                        raise ConnectionError("Connection closed during message reception")
-                    encrypted_message_bytes += chunk
-                    remaining -= len(chunk)
+            outbox = ClientOutbox(
+                client_socket,
+                seal=lambda item: self.seal(item, session, compression),
+                max_bytes=self.max_queued_bytes,
+                max_delay=self.max_queue_delay,
+                policy=self.slow_consumer,
+                flush_delay=self.flush_delay,
+                metrics=self.metrics
+            )
+            if ticket:
+                # First in the queue, so it goes out in the same write as the join messages
+                outbox.put(ticket)
+            outbox.start()
+            watch.handshake_done(outbox)
+            client.username = username
+            client.outbox = outbox
+            if self.rate_limit:
+                client.bucket = TokenBucket(self.rate_limit, self.rate_burst)
 
-                encrypted_message = encrypted_message_bytes.decode('utf-8')
-                message = self.decrypt_message(encrypted_message, session_key, iv)
+            with self.lock:
+                self.add_client(client)
+                self.open_mailbox(client)
 
-                with self.lock:
-                    self.broadcast(f"{username}: {message}")
+            while True:
+                frame = read_frame(client_socket, decoder)
+                if frame is None:
+                    break
+
+                watch.touch()
+                frame_type, flags, payload = frame
+                self.handle_frame(client, frame_type, flags, payload)
 
         except Exception as e:
-            print(f"Error handling client {address}: {e}")
+            log(f"Error handling client {address}: {e}")
         finally:
             with self.lock:
-                if username and username in self.clients:
-                    del self.clients[username]
-                    self.broadcast(f"{username} has left the chat.")
+                if claimed and self.clients.get(username) is client:
+                    self.remove_client(username)
+                    self.leave_all_rooms(username, keep=True)
+            if claimed:
+                self.cancel_transfers(client)
+                if not client.taken_over:
+                    self.release_username(username)
+            if outbox:
+                outbox.close()
+            watch.close()
             client_socket.close()
-            print(f"Connection closed for {address[0]}:{address[1]}")
-    def broadcast(self, message):
-        print(message)
+            self.release_connection()
+            log(f"Connection closed for {address[0]}:{address[1]}")
+
+    def claim_username(self, username):
+        """Reserve username for a new client, False if it is in use here or on another worker"""
+        with self.lock:
+            if username in self.usernames:
+                return False
+            self.usernames.add(username)
+        if self.bus and not self.bus.claim(username).result():
+            with self.lock:
+                self.usernames.discard(username)
+            return False
+        return True
+
+    async def claim_username_async(self, username):
+        if username in self.usernames:
+            return False
+        self.usernames.add(username)
+        if self.bus and not await asyncio.wrap_future(self.bus.claim(username)):
+            self.usernames.discard(username)
+            return False
+        return True
+
+    def take_over(self, username):
+        """Hand username over to a session resumed with its ticket, closing the connection it has here.
+
+        The old connection may be half open and would otherwise hold the name
+        until the idle timeout. It leaves its rooms the way a dropped one
+        does, so the new session gets the mailbox and the rooms back.
+        """
+        with self.lock:
+            old = self.clients.get(username)
+            if old is None:
+                # Still in its handshake here, or connected to another worker
+                return False
+            old.taken_over = True
+            self.remove_client(username)
+            self.leave_all_rooms(username, announce=False, keep=True)
+        old.outbox.close()
+        log(f"User {username} resumed on a new connection, closing the old one")
+        return True
+
+    def release_username(self, username):
+        with self.lock:
+            self.usernames.discard(username)
+        if self.bus:
+            self.bus.release(username)
+
+    def add_client(self, client):
+        """Publish a new snapshot of the registry with client in it, under self.lock"""
+        self.clients = {**self.clients, client.username: client}
+
+    def remove_client(self, username):
+        clients = dict(self.clients)
+        del clients[username]
+        self.clients = clients
+
+    def handle_frame(self, client, frame_type, flags, payload):
+        """Act on one frame from a connected client"""
+        username = client.username
+        self.metrics.messages_in.inc()
+        self.metrics.bytes_in.inc(len(payload))
+        if frame_type == ACK:
+            mailbox = self.mailboxes.get(username)
+            if mailbox and len(payload) == SEQUENCE.size:
+                mailbox.ack(*SEQUENCE.unpack(payload))
+            return
+        if frame_type not in (MESSAGE, JOIN, PART, LIST_ROOMS, DIRECT, HISTORY, FILE_OFFER, FILE_CHUNK, FILE_END):
+            return
+        # Decrypt before anything else so the session and compression streams stay in step
+        data = self.decrypt_data(frame_type, payload, client.session, client.compression, flags)
+        if frame_type in (FILE_CHUNK, FILE_END):
+            # Paced by the transfer's credits instead of the rate limit
+            self.relay_file_data(client, frame_type, data)
+            return
+
+        bucket = client.bucket
+        if bucket and not bucket.take():
+            self.metrics.rate_limited.inc()
+            if bucket.refused == 1:
+                self.send_to(username, "You are sending too fast, your messages are being dropped.")
+            if frame_type == FILE_OFFER:
+                self.refuse_file(client, data)
+            return
+
+        if frame_type == FILE_OFFER:
+            self.offer_file(client, data)
+            return
+        if frame_type in (MESSAGE, DIRECT) and len(data) > MAX_MESSAGE_BYTES:
+            self.send_to(username, f"Messages are limited to {MAX_MESSAGE_BYTES // 1024} KB, yours was not sent.")
+            return
+        text = data.decode('utf-8')
+
+        if frame_type == DIRECT:
+            recipient, _, text = text.partition('\n')
+            self.send_direct(username, recipient.strip(), text)
+            return
+
+        if frame_type == MESSAGE:
+            # Chat goes out from the registry and member snapshots without the
+            # lock, so broadcasts never wait behind joins and leaves
+            room_name = self.active_rooms.get(username)
+            if room_name is None:
+                self.send_to(username, "You are not in any room. Use '/join room_name' first.")
+            else:
+                self.broadcast(text, room_name, sender=username)
+            return
+
+        with self.lock:
+            if frame_type == JOIN:
+                self.join_room(username, text.strip())
+            elif frame_type == PART:
+                room_name = text.strip() or self.active_rooms.get(username)
+                if room_name is None:
+                    self.send_to(username, "You are not in any room.")
+                else:
+                    self.leave_room(username, room_name)
+            elif frame_type == LIST_ROOMS:
+                self.send_to(username, self.describe_rooms(username))
+            elif frame_type == HISTORY:
+                self.handle_history_request(username, text.strip())
+
+    def join_room(self, username, room_name, replay=True):
+        if not room_name or len(room_name) > MAX_ROOM_NAME or any(c.isspace() for c in room_name):
+            self.send_to(username, f"Room names are 1-{MAX_ROOM_NAME} characters without spaces.")
+            return
+
+        room = self.get_room(room_name)
+        self.active_rooms[username] = room_name
+        if username in room.members:
+            self.send_to(username, f"Now talking in [{room_name}].")
+            return
+
+        self.set_members(room, {**room.members, username: self.clients[username]})
+        self.user_rooms.setdefault(username, set()).add(room_name)
+        self.broadcast(f"[{room_name}] {username} has joined.", room_name)
+        if replay:
+            self.replay_history(username, room_name, self.history_replay)
+
+    def leave_room(self, username, room_name, announce=True):
+        room = self.rooms.get(room_name)
+        if room is None or username not in room.members:
+            if announce:
+                self.send_to(username, f"You are not in [{room_name}].")
+            return
+
+        members = dict(room.members)
+        del members[username]
+        self.set_members(room, members)
+        rooms = self.user_rooms.get(username, set())
+        rooms.discard(room_name)
+        if not rooms:
+            self.user_rooms.pop(username, None)
+        if self.active_rooms.get(username) == room_name:
+            # Keep talking in another room the user is still in, if any
+            if rooms:
+                self.active_rooms[username] = next(iter(rooms))
+            else:
+                self.active_rooms.pop(username, None)
+
+        if not members and not room.away:
+            del self.rooms[room_name]
+        if announce:
+            self.send_to(username, f"You left [{room_name}].")
+            # Published even when no local member is left, other workers may have some
+            self.broadcast(f"[{room_name}] {username} has left.", room_name, exclude=username)
+
+    def leave_all_rooms(self, username, announce=True, keep=False):
+        """Take a user out of every room, returns the rooms with the one they were talking in last.
+
+        With keep the user's mailbox starts holding the rooms' messages before
+        the user leaves them, so no broadcast falls between the two.
+        """
+        active = self.active_rooms.get(username)
+        rooms = sorted(self.user_rooms.get(username, ()), key=lambda room_name: room_name == active)
+        if keep:
+            self.keep_mailbox(username, rooms)
+        for room_name in rooms:
+            self.leave_room(username, room_name, announce)
+        self.active_rooms.pop(username, None)
+        return rooms
+
+    def handle_history_request(self, username, arg):
+        """/history [count] or /history minutes followed by m, for the room the user talks in"""
+        room_name = self.active_rooms.get(username)
+        if not self.history or room_name is None:
+            self.send_to(username, "No history available.")
+            return
+        try:
+            if arg.endswith('m'):
+                self.replay_history(username, room_name, MAX_HISTORY_REPLAY, time.time() - float(arg[:-1]) * 60, True)
+            else:
+                count = int(arg) if arg else self.history_replay
+                self.replay_history(username, room_name, min(count, MAX_HISTORY_REPLAY), None, True)
+        except ValueError:
+            self.send_to(username, "Usage: /history [count | minutes followed by m]")
+
+    def replay_history(self, username, room_name, limit, since=None, always_reply=False):
+        """Send the recent messages of a room to one user, in as few messages as fit the frame limit"""
+        messages = self.history.recent(room_name, limit, since) if self.history and limit > 0 else []
+        if not messages:
+            if always_reply:
+                self.send_to(username, f"No messages in [{room_name}] history.")
+            return
+        lines = [f"Last {len(messages)} messages in [{room_name}]:"]
+        size = len(lines[0])
+        for timestamp, sender, body in messages:
+            # Older history may hold messages from before MAX_MESSAGE_BYTES
+            line = f"  {time.strftime('%H:%M', time.localtime(timestamp))} {sender}: {body[:MAX_MESSAGE_BYTES]}"
+            line_size = len(line.encode('utf-8')) + 1
+            if size + line_size > HISTORY_CHUNK_BYTES:
+                self.send_to(username, "\n".join(lines))
+                lines, size = [], 0
+            lines.append(line)
+            size += line_size
+        self.send_to(username, "\n".join(lines))
+
+    def describe_rooms(self, username):
+        # Rooms kept only for users who dropped recently are not listed
+        rooms = {room_name: room for room_name, room in self.rooms.items() if room.members}
+        if not rooms:
+            return "There are no rooms. Use '/join room_name' to create one."
+        lines = ["Rooms (* = joined):"]
+        for room_name in sorted(rooms):
+            room = rooms[room_name]
+            marker = '*' if username in room.members else ' '
+            active = ', talking here' if self.active_rooms.get(username) == room_name else ''
+            lines.append(f" {marker} {room_name} ({len(room.members)} members{active})")
+        return "\n".join(lines)
+
+    def send_to(self, username, message):
+        """Queue a message for one local client, False if the user isn't connected here"""
+        client = self.clients.get(username)
+        if not client:
+            return False
+        self.metrics.messages_out.inc()
+        return self.queue_message(username, client.outbox, message)
+
+    def queue_message(self, username, outbox, message, frame=None):
+        """Put a message in a client's outbox, numbered by the user's mailbox when there is one.
+
+        frame is the GROUP_MESSAGE frame to send instead of the text; the
+        mailbox keeps the text, which a later replay encrypts for the session.
+        """
+        item = frame if frame is not None else message
+        mailbox = self.mailboxes.get(username)
+        if mailbox is None:
+            return outbox.put(item)
+        with mailbox.lock:
+            seq = mailbox.add(message)
+            if mailbox.offline and self.offline_store:
+                # A broadcast that still had the user in its snapshot, the outbox is already closed
+                self.offline_store.append(username, seq, message)
+            return outbox.put(Sequenced(mailbox.id, seq, item))
+
+    def hold_message(self, username, message):
+        """Keep a message for a user who is offline, False if the user has no mailbox here.
+
+        A user who is back already but has not rejoined the room yet gets the
+        message in their outbox instead, behind the held ones. One who is
+        dropping again, gone from the registry but not yet marked offline,
+        gets it in the mailbox, which keep_mailbox is about to hold.
+        """
+        mailbox = self.mailboxes.get(username)
+        if mailbox is None:
+            return False
+        with mailbox.lock:
+            client = self.clients.get(username)
+            if not mailbox.offline and client is not None:
+                return self.queue_message(username, client.outbox, message)
+            seq = mailbox.add(message)
+            if mailbox.offline and self.offline_store:
+                self.offline_store.append(username, seq, message)
+        self.metrics.held.inc()
+        return True
+
+    def open_mailbox(self, client):
+        """Set up delivery for a user who just connected.
+
+        A user coming back within offline_hold gets everything held in one
+        burst, with the original sequence numbers so the client skips what it
+        already has, and is put back in their rooms. Coming back means the
+        same client key pair, which a session resumed with its ticket always
+        has: someone else taking the name gets none of the held messages.
+        Anyone else starts a new mailbox in the default room.
+        """
+        username, outbox = client.username, client.outbox
+        owner = client.public_key.public_bytes(
+            encoding=serialization.Encoding.DER,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        mailbox = self.mailboxes.get(username)
+        if mailbox and mailbox.offline and mailbox.owner != owner:
+            log(f"User {username} connected with another key, discarding the messages held for them")
+            self.discard_mailbox(username, mailbox)
+            mailbox = None
+        if not self.offline_hold or mailbox is None or not mailbox.offline:
+            if self.offline_hold:
+                self.mailboxes[username] = Mailbox(self.offline_max_messages, owner=owner)
+            self.join_room(username, DEFAULT_ROOM)
+            return
+
+        mailbox.expiry.cancel()
+        with mailbox.lock:
+            mailbox.offline = False
+            for seq, message in mailbox.pending:
+                outbox.put(Sequenced(mailbox.id, seq, message))
+            lost, mailbox.lost = mailbox.lost, 0
+        if self.offline_store:
+            self.offline_store.remove(username)
+        if lost:
+            self.send_to(username, f"{lost} older messages sent while you were away did not fit in your queue.")
+        for room_name in mailbox.rooms or [DEFAULT_ROOM]:
+            self.join_room(username, room_name, replay=False)
+        # Only now, until the user is in the rooms' members broadcasts find them in away
+        self.release_away(username, mailbox)
+
+    def keep_mailbox(self, username, rooms):
+        """Start holding messages of rooms, the ones a user was in, for a user who just disconnected"""
+        mailbox = self.mailboxes.get(username)
+        if mailbox is None:
+            return
+        with mailbox.lock:
+            mailbox.offline = True
+            mailbox.rooms = rooms
+            if self.offline_store:
+                self.offline_store.save(username, mailbox)
+        self.hold_mailbox(username, mailbox)
+
+    def hold_mailbox(self, username, mailbox):
+        for room_name in mailbox.rooms:
+            room = self.get_room(room_name)
+            self.set_away(room, room.away | {username})
+        mailbox.expiry = self.timers.schedule(self.offline_hold, lambda: self.expire_mailbox(username, mailbox))
+
+    def release_away(self, username, mailbox):
+        for room_name in mailbox.rooms:
+            room = self.rooms.get(room_name)
+            if room is None or username not in room.away:
+                continue
+            self.set_away(room, room.away - {username})
+            if not room.members and not room.away:
+                del self.rooms[room_name]
+
+    def expire_mailbox(self, username, mailbox):
+        """Timer callback: drop the mailbox of a user who did not come back in time"""
+        with self.lock:
+            if self.mailboxes.get(username) is not mailbox or not mailbox.offline:
+                return
+            self.discard_mailbox(username, mailbox)
+
+    def discard_mailbox(self, username, mailbox):
+        """Drop an offline mailbox and what it holds, under self.lock"""
+        mailbox.expiry.cancel()
+        del self.mailboxes[username]
+        self.release_away(username, mailbox)
+        if self.offline_store:
+            self.offline_store.remove(username)
+
+    def send_direct(self, sender, recipient, text):
+        """Unicast a private message.
+
+        Runs without self.lock: the recipient is a single lookup in the
+        clients map and the only lock taken is the one of the recipient's
+        outbox, so private messages neither wait for nor hold up broadcasts.
+        The recipient's writer encrypts the message with its own session.
+        """
+        if not recipient or not text:
+            self.send_to(sender, "Usage: /msg username message")
+            return
+
+        message = f"[private] {sender} -> {recipient}: {text}"
+        if self.send_to(recipient, message):
+            if recipient != sender:
+                # The echo, a note to yourself is already in your outbox
+                self.send_to(sender, message)
+        elif self.hold_message(recipient, message):
+            self.send_to(sender, message)
+            self.send_to(sender, f"{recipient} is offline, the message is delivered when they reconnect.")
+        elif self.bus:
+            # Not on this worker, the hub routes it and echoes it back, or tells the sender the user is offline
+            self.bus.send_direct(recipient, sender, message)
+        else:
+            self.send_to(sender, f"User {recipient} is not online.")
+
+    def receive_direct_from_bus(self, recipient, message):
+        """Called from the bus thread with a direct message for a user on this worker"""
+        self.send_to(recipient, message)
+
+    def offer_file(self, client, data):
+        """Start relaying a file to the other local members of the room the sender talks in.
+
+        Like broadcasts it runs without self.lock, on the room's member
+        snapshot. Members of other workers and offline users do not get it.
+        """
+        if len(data) < FILE_HEADER.size:
+            raise ConnectionError("Truncated file offer")
+        transfer_id, size = FILE_HEADER.unpack_from(data)
+        raw_name = data[FILE_HEADER.size:]
+        name = safe_file_name(raw_name.decode('utf-8')) if len(raw_name) <= MAX_FILE_NAME else ''
+        username = client.username
+        room_name = self.active_rooms.get(username)
+        room = self.rooms.get(room_name) if room_name else None
+        recipients = [member for member in room.members.values() if member is not client] if room else []
+        if not self.max_file_size:
+            refusal = "File transfers are disabled on this server."
+        elif size > self.max_file_size:
+            refusal = f"Files are limited to {format_size(self.max_file_size)}."
+        elif not name:
+            refusal = f"File names are limited to {MAX_FILE_NAME} bytes."
+        elif transfer_id in client.transfers:
+            refusal = f"You are already sending a file with id {transfer_id}."
+        elif not recipients:
+            refusal = f"Nobody else is in [{room_name}]." if room_name else "You are not in any room."
+        else:
+            refusal = None
+        if refusal:
+            self.send_to(username, refusal)
+            self.refuse_file(client, data)
+            return
+
+        transfer = Transfer(transfer_id, next(self.transfer_ids) % (1 << 32), client, recipients, room_name, name,
+                            size, FILE_WINDOW, FILE_CHUNK_SIZE)
+        client.transfers[transfer_id] = transfer
+        log(f"{username} is sending {name} ({size} bytes) to [{room_name}]")
+        transfer.relay(FILE_OFFER, FILE_HEADER.pack(transfer.relay_id, size) +
+                       f"{room_name}\n{username}\n{name}".encode('utf-8'))
+        self.send_to(username, f"Sending {name} to {len(transfer.recipients)} members of [{room_name}]...")
+        transfer.grant(FILE_WINDOW)
+
+    def refuse_file(self, client, data):
+        """Tell the sender of a FILE_OFFER not to send any chunks"""
+        if len(data) >= FILE_ID.size:
+            client.outbox.put_bulk(encode_frame(FILE_CREDIT, FILE_CREDIT_GRANT.pack(FILE_ID.unpack_from(data)[0], 0)))
+
+    def relay_file_data(self, client, frame_type, data):
+        """Pass a FILE_CHUNK or FILE_END of one of the client's transfers on to its recipients"""
+        if len(data) < FILE_ID.size:
+            raise ConnectionError("Truncated file frame")
+        transfer = client.transfers.get(FILE_ID.unpack_from(data)[0])
+        if transfer is None:
+            # Refused or stopped, chunks sent before the sender heard of it are dropped
+            return
+        if frame_type == FILE_END:
+            del client.transfers[transfer.id]
+            status = transfer.finish(data[FILE_ID.size] if len(data) > FILE_ID.size else FILE_DONE)
+            done = status == FILE_DONE
+            log(f"{client.username} {'sent' if done else 'cancelled'} {transfer.name} to [{transfer.room_name}]")
+            self.send_to(client.username, f"{'Sent' if done else 'Cancelled'} {transfer.name} "
+                                          f"to [{transfer.room_name}].")
+            return
+
+        chunk = data[FILE_ID.size:]
+        if len(chunk) > FILE_CHUNK_SIZE or not transfer.take_credit():
+            raise ConnectionError("File chunk beyond the granted credit or chunk size")
+        if transfer.received + len(chunk) > transfer.size:
+            raise ConnectionError(f"{transfer.name} is larger than offered")
+        self.metrics.file_bytes.inc(len(chunk))
+        if not transfer.relay_chunk(chunk):
+            del client.transfers[transfer.id]
+            transfer.grant(0)
+            self.send_to(client.username, f"Stopped sending {transfer.name}, nobody is left to receive it.")
+
+    def cancel_transfers(self, client):
+        """The sender is gone, tell the recipients of its unfinished files"""
+        for transfer in client.transfers.values():
+            transfer.finish(FILE_CANCELLED)
+            log(f"{client.username} cancelled {transfer.name} to [{transfer.room_name}]")
+        client.transfers.clear()
+
+    def broadcast(self, message, room_name=DEFAULT_ROOM, sender='', exclude=None):
+        """Send a message to a room, including its members on other worker processes.
+
+        Chat text comes with its sender and goes to the history log, server
+        notices have no sender. exclude is a user the message is not held
+        for, the one whose departure it announces.
+        """
+        self.deliver(message, room_name, sender, exclude)
+        if self.bus:
+            self.bus.publish(room_name, sender, message)
+
+    def receive_from_bus(self, room_name, sender, message):
+        """Called from the bus thread with a message broadcast on another worker"""
+        self.deliver(message, room_name, sender)
+
+    def deliver(self, message, room_name, sender='', exclude=None):
+        """Queue a message for the local members of a room, never blocks on a client's socket.
+
+        Needs no lock: it reads the room's snapshot once and only takes the
+        lock to remove clients whose outbox refused the message. Two senders
+        broadcasting at once may reach members in different orders.
+
+        A user who drops joins away before leaving the members and leaves
+        away only after rejoining them, and both are in the one snapshot read
+        here, so a broadcast always finds them in one or the other.
+        """
+        if sender:
+            if self.history:
+                # Only queued here, the log's writer thread does the disk work
+                self.history.append(room_name, sender, message)
+            message = f"[{room_name}] {sender}: {message}"
+        log(message)
+        room = self.rooms.get(room_name)
+        if room is None:
+            return
+        members, key, away = room.snapshot
+        # Members who dropped recently get it when they are back
+        for uname in away:
+            if uname not in members and uname != exclude:
+                self.hold_message(uname, message)
         disconnected_clients = []
+        fanout_start = time.perf_counter()
 
-        for uname, (client, encryption_info) in self.clients.items():
-            try:
-                # Encrypt message specifically for this client
-                encrypted_msg = self.encrypt_message(
-                    message,
-                    encryption_info['session_key'],
-                    encryption_info['iv']
-                )
-                client.send(encrypted_msg.encode('utf-8'))
-            except:
-                disconnected_clients.append(uname)
+        # In group key mode the message is encrypted once and the same buffer goes to every member
+        group_msg = None
+        if room.group_key:
+            with self.metrics.group_encrypt.time():
+                group_msg = room.group_key.encrypt_message(message, key)
+
+        for client in members.values():
+            # Without a group key the plain message is queued and the client's
+            # writer encrypts it with that client's session stream
+            if not self.queue_message(client.username, client.outbox, message, group_msg):
+                disconnected_clients.append(client)
+        self.metrics.messages_out.inc(len(members))
+        self.metrics.fanout.observe(time.perf_counter() - fanout_start)
+
+        # Remove disconnected and too slow clients, unless their handler got there first
+        for client in disconnected_clients:
+            with self.lock:
+                if self.clients.get(client.username) is not client:
+                    continue
+                self.remove_client(client.username)
+                client.outbox.close()
+                self.leave_all_rooms(client.username, announce=False, keep=True)
+            log(f"Removed disconnected client: {client.username}")
+
+    def set_members(self, room, members):
+        """Publish a room's new member map, under self.lock.
+
+        In group key mode the change also replaces the room key. The new key
+        is queued for every member before the snapshot pairing it with them
+        is published, so no member can get a message under it first; a
+        broadcast still using the old snapshot uses a key its members have.
+        """
+        key = None
+        if room.group_key:
+            key = room.group_key.new_key()
+            for client in members.values():
+                # A failed put closes the outbox, the client's handler cleans up after it
+                client.outbox.put(room.group_key.wrap_for(client.public_key, key))
+        room.snapshot = (members, key, room.away)
 
-        # Remove disconnected clients
-        for uname in disconnected_clients:
-            if uname in self.clients:
-                del self.clients[uname]
-                print(f"Removed disconnected client: {uname}")
+    def set_away(self, room, away):
+        """Publish a room's new set of away users, under self.lock"""
+        members, key, _ = room.snapshot
+        room.snapshot = (members, key, away)
+
+    def get_room(self, room_name):
+        """The room of that name, created empty when there is none, under self.lock"""
+        room = self.rooms.get(room_name)
+        if room is None:
+            room = self.rooms[room_name] = Room(room_name, self.group_key_mode)
+        return room
 
     def get_local_ip(self):
         """Get the local IP address of the server"""
@@ -267,6 +1624,9 @@ class ChatServer:
     def get_ngrok_url(self):
         """Get ngrok public URL if running"""
         try:
+            # Imported here so server start-up doesn't pay for it
+            import requests
+
             # Try to get the ngrok tunnel info from the API
             response = requests.get('http://localhost:4040/api/tunnels')
             if response.status_code == 200:
@@ -279,10 +1639,286 @@ class ChatServer:
             return None
 
 
+class AsyncChatServer(ChatServer):
+    """Single event loop server, speaks the same wire protocol as ChatServer.
+
+    Every connection is a task on non-blocking sockets instead of a thread, so
+    idle clients only cost their socket and a small receive buffer.
+    """
+
+    def __init__(self, host='0.0.0.0', port=8000, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.server_socket.setblocking(False)
+        self.tasks = set()
+        self.loop = None
+
+    def start(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print("Server shutting down...")
+        finally:
+            self.server_socket.close()
+            if self.history:
+                self.history.close()
+            if self.offline_store:
+                self.offline_store.close()
+            flush_log()
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self.server_socket.listen(self.backlog)
+        print(f"Encrypted server (asyncio) started on {self.host}:{self.port}")
+        print(f"Host key fingerprint: {self.host_key_fingerprint()}")
+
+        if self.benchmark_startup:
+            probe = socket.create_connection((self.probe_host(), self.port))
+            client_socket, _ = await loop.sock_accept(self.server_socket)
+            client_socket.close()
+            probe.close()
+            self.report_startup()
+            return
+
+        # Address discovery is slow and not needed to serve, do it after the listener is up
+        loop.run_in_executor(None, self.announce)
+        self.loop = loop
+        self.tick_timers()
+        if self.bus:
+            self.bus.start()
+        self.start_admin()
+
+        while True:
+            client_socket, address = await loop.sock_accept(self.server_socket)
+            self.metrics.connections.inc()
+            if not self.admit_connection(client_socket, address):
+                continue
+            client_socket.setblocking(False)
+            log(f"New connection from {address[0]}:{address[1]}")
+            task = loop.create_task(self.handle_client(client_socket, address))
+            # Keep a reference so the task isn't garbage collected while running
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def tick_timers(self):
+        """Advance the timer wheel on the event loop, so timeouts run next to the connections"""
+        self.timers.advance()
+        self.loop.call_later(self.timers.tick, self.tick_timers)
+
+    def receive_from_bus(self, room_name, sender, message):
+        self.loop.call_soon_threadsafe(self.deliver, message, room_name, sender)
+
+    def receive_direct_from_bus(self, recipient, message):
+        self.loop.call_soon_threadsafe(self.send_to, recipient, message)
+
+    async def handle_client(self, client_socket, address):
+        loop = asyncio.get_running_loop()
+        username = None
+        claimed = False
+        outbox = None
+        decoder = FrameDecoder()
+        handshake_start = time.monotonic()
+        watch = ConnectionWatch(self, client_socket, address)
+
+        try:
+            # The outbox writes whole batches of frames, Nagle would only hold them back
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            # STEP 1: Send server's public key
+            await loop.sock_sendall(client_socket, encode_frame(PUBLIC_KEY, self.public_key_pem,
+                                                                COMPRESSED if self.compression else 0))
+
+            # STEP 2: The client either resumes with a ticket or starts a full handshake
+            frame = await read_frame_async(loop, client_socket, decoder)
+            resumed = None
+            if frame is not None and frame[0] == RESUME:
+                resumed = self.try_resume(frame[2])
+                if resumed:
+                    await loop.sock_sendall(client_socket, encode_frame(RESUME_OK, resumed[0]))
+                else:
+                    await loop.sock_sendall(client_socket, encode_frame(RESUME_FAILED, b''))
+                    frame = await read_frame_async(loop, client_socket, decoder)
+
+            if resumed:
+                username_frame = await read_frame_async(loop, client_socket, decoder)
+                username, client = self.complete_resume(resumed, username_frame)
+            else:
+                # STEP 2-4: Receive client's public key, wrapped session key and IV, encrypted username
+                client_public_key_pem = expect_frame(frame, PUBLIC_KEY)
+                wrapped_secret = expect_frame(await read_frame_async(loop, client_socket, decoder), SESSION_KEY)
+                username_frame = await read_frame_async(loop, client_socket, decoder)
+
+                session_secret = await self.unwrap_session_secret_async(wrapped_secret)
+                username, client = self.complete_handshake(
+                    client_public_key_pem, session_secret, username_frame
+                )
+            session = client.session
+            compression = client.compression = self.negotiate_compression(username_frame[1])
+            self.handshake_stats.record(time.monotonic() - handshake_start)
+            self.metrics.handshakes.observe(time.monotonic() - handshake_start)
+
+            if not await self.claim_username_async(username) and not (resumed and self.take_over(username)):
+                await loop.sock_sendall(client_socket, self.encrypt_message(f"Username {username} is already taken.", session))
+                log(f"Rejected {address[0]}:{address[1]}, username {username} is already taken")
+                return
+            claimed = True
+
+            ticket = self.ticket_frame(username, client)
+
+            log(f"User {username} {'resumed' if resumed else 'connected'} from {address[0]}:{address[1]} (encrypted)")
+
+            outbox = AsyncClientOutbox(
+                client_socket,
+                seal=lambda item: self.seal(item, session, compression),
+                max_bytes=self.max_queued_bytes,
+                max_delay=self.max_queue_delay,
+                policy=self.slow_consumer,
+                flush_delay=self.flush_delay,
+                metrics=self.metrics
+            )
+            if ticket:
+                # First in the queue, so it goes out in the same write as the join messages
+                outbox.put(ticket)
+            outbox.start()
+            watch.handshake_done(outbox)
+            client.username = username
+            client.outbox = outbox
+            if self.rate_limit:
+                client.bucket = TokenBucket(self.rate_limit, self.rate_burst)
+
+            self.add_client(client)
+            self.open_mailbox(client)
+
+            while True:
+                frame = await read_frame_async(loop, client_socket, decoder)
+                if frame is None:
+                    break
+
+                watch.touch()
+                frame_type, flags, payload = frame
+                self.handle_frame(client, frame_type, flags, payload)
+
+        except Exception as e:
+            log(f"Error handling client {address}: {e}")
+        finally:
+            if claimed and outbox and self.clients.get(username) is client:
+                self.remove_client(username)
+                self.leave_all_rooms(username, keep=True)
+            if claimed:
+                self.cancel_transfers(client)
+                if not client.taken_over:
+                    self.release_username(username)
+            if outbox:
+                outbox.close()
+            watch.close()
+            client_socket.close()
+            self.release_connection()
+            log(f"Connection closed for {address[0]}:{address[1]}")
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Chat Server with ngrok support")
     parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+    parser.add_argument('--engine', choices=['threaded', 'asyncio'], default='threaded',
+                        help='Connection handling engine (thread per client or a single event loop)')
+    parser.add_argument('--slow-consumer', choices=['drop-oldest', 'disconnect'], default='drop-oldest',
+                        help='What to do with a client whose outbound queue is full')
+    parser.add_argument('--max-queued-bytes', type=int, default=1024 * 1024,
+                        help='Outbound bytes queued per client before the slow-consumer policy applies')
+    parser.add_argument('--max-queue-delay', type=float, default=0,
+                        help='Seconds a message may wait in a client queue before the policy applies (0 disables)')
+    parser.add_argument('--flush-delay', type=float, default=0,
+                        help='Seconds a client writer may wait to batch more messages into one write (0 sends right away)')
+    parser.add_argument('--no-compression', action='store_true',
+                        help='Do not offer clients compression of their messages')
+    parser.add_argument('--compression-threshold', type=int, default=32,
+                        help='Messages shorter than this many bytes are sent uncompressed')
+    parser.add_argument('--backlog', type=int, default=1024,
+                        help='Connections the kernel queues for accept')
+    parser.add_argument('--max-connections', type=int, default=0,
+                        help='Connections served at once, more are closed right after accept (0 = no limit)')
+    parser.add_argument('--handshake-timeout', type=float, default=10,
+                        help='Seconds a new connection has to finish its handshake (0 disables)')
+    parser.add_argument('--idle-timeout', type=float, default=300,
+                        help='Seconds without a frame before a client is closed, it is pinged halfway (0 disables)')
+    parser.add_argument('--rate-limit', type=float, default=10,
+                        help='Frames per second a user may send on average, more are dropped (0 disables)')
+    parser.add_argument('--rate-burst', type=int, default=30,
+                        help='Frames a user may send at once before the rate limit applies')
+    parser.add_argument('--offline-hold', type=float, default=120,
+                        help='Seconds messages are kept for a disconnected user, delivered when they reconnect (0 disables)')
+    parser.add_argument('--offline-max-messages', type=int, default=1000,
+                        help='Messages kept per disconnected user, the oldest are dropped first')
+    parser.add_argument('--offline-dir', default=None,
+                        help='Also keep the messages for disconnected users in this directory, across restarts')
+    parser.add_argument('--max-file-size', type=float, default=100,
+                        help='Largest file in MB users may send to a room with /send (0 disables file transfers)')
+    parser.add_argument('--group-key', action='store_true',
+                        help='Encrypt each broadcast once with a shared room key instead of once per client')
+    parser.add_argument('--handshake-pool', choices=['thread', 'process', 'none'], default='thread',
+                        help='Where the RSA part of the handshake runs (none = inline on the connection)')
+    parser.add_argument('--handshake-workers', type=int, default=None,
+                        help='Size of the handshake pool (default: number of CPUs)')
+    parser.add_argument('--stats-interval', type=float, default=10,
+                        help='Seconds between handshake rate reports (0 disables)')
+    parser.add_argument('--ticket-lifetime', type=int, default=3600,
+                        help='Seconds a session resumption ticket stays valid (0 disables resumption)')
+    parser.add_argument('--host-key', default=None,
+                        help='Load the server RSA key from this file, generating it on first run')
+    parser.add_argument('--benchmark-startup', action='store_true',
+                        help='Exit after the first accepted connection, printing the time it took to get there')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='Serve metrics and the profiler on this local port (0 disables)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes sharing the port with SO_REUSEPORT')
+    parser.add_argument('--history-dir', default=None,
+                        help='Keep a message history log in this directory (disabled by default)')
+    parser.add_argument('--history-replay', type=int, default=20,
+                        help='Number of recent messages sent to a user joining a room')
+    parser.add_argument('--history-segment-mb', type=int, default=16,
+                        help='Size at which the history log starts a new segment file')
+    parser.add_argument('--history-segments', type=int, default=8,
+                        help='Number of history segment files kept, older ones are deleted')
     args = parser.parse_args()
 
-    server = ChatServer(port=args.port)
-    server.start()
\ No newline at end of file
+    options = dict(
+        port=args.port,
+        max_queued_bytes=args.max_queued_bytes,
+        max_queue_delay=args.max_queue_delay,
+        slow_consumer=args.slow_consumer,
+        flush_delay=args.flush_delay,
+        metrics_port=args.metrics_port,
+        compression=not args.no_compression,
+        compression_threshold=args.compression_threshold,
+        backlog=args.backlog,
+        max_connections=args.max_connections,
+        handshake_timeout=args.handshake_timeout,
+        idle_timeout=args.idle_timeout,
+        rate_limit=args.rate_limit,
+        rate_burst=args.rate_burst,
+        offline_hold=args.offline_hold,
+        offline_max_messages=args.offline_max_messages,
+        offline_dir=args.offline_dir,
+        max_file_size=int(args.max_file_size * 1024 * 1024),
+        group_key=args.group_key,
+        handshake_pool=args.handshake_pool,
+        handshake_workers=args.handshake_workers,
+        stats_interval=args.stats_interval,
+        ticket_lifetime=args.ticket_lifetime,
+        host_key_path=args.host_key,
+        benchmark_startup=args.benchmark_startup,
+        history_dir=args.history_dir,
+        history_replay=args.history_replay,
+        history_segment_bytes=args.history_segment_mb * 1024 * 1024,
+        history_segments=args.history_segments
+    )
+    server_class = AsyncChatServer if args.engine == 'asyncio' else ChatServer
+
+    if args.workers > 1:
+        from cluster import run_cluster
+
+        # Keys are created once here so all workers share them
+        options['private_key'] = create_host_key(options.pop('host_key_path'))
+        options['ticket_key'] = AESGCM.generate_key(bit_length=256)
+        run_cluster(server_class, args.workers, options)
+    else:
+        server = server_class(**options)
+        server.start()
\ No newline at end of file
@@ -41,7 +41,7 @@ After=network.target
 [Service]
 User=$USER
 WorkingDirectory=/home/$USER/chatroom
-ExecStart=/home/$USER/chatroom/.venv/bin/python /home/$USER/chatroom/server.py --port 8000
+ExecStart=/home/$USER/chatroom/.venv/bin/python /home/$USER/chatroom/server.py --port 8000 --host-key /home/$USER/chatroom/host_key.pem
 
 [Install]
 WantedBy=multi-user.target
@@ -0,0 +1,182 @@
+import os
+import threading
+from framing import (encode_frame, FILE_ID, FILE_CREDIT, FILE_CREDIT_GRANT, FILE_CHUNK, FILE_END,
+                     FILE_DONE, FILE_CANCELLED)
+
+
+class FileFrame:
+    """An outbox item for a file transfer frame, encrypted with the recipient's session when sent"""
+    __slots__ = ('frame_type', 'data')
+
+    def __init__(self, frame_type, data):
+        self.frame_type = frame_type
+        self.data = data  # shared by every recipient
+
+    def __len__(self):
+        return len(self.data)
+
+
+def format_size(size):
+    for unit in ('bytes', 'KB', 'MB'):
+        if size < 1024 or unit == 'MB':
+            return f"{size} {unit}" if unit == 'bytes' else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+class Transfer:
+    """A file on its way from one sender to the room members there were when it was offered.
+
+    Nothing is buffered beyond the outboxes: every chunk is queued for each
+    recipient as it arrives and the server never holds the file. The sender
+    may only send chunks it has credit for; it starts with window chunks and
+    gets one back for each chunk relayed once every recipient has fewer than
+    window chunks waiting, so the transfer runs at the pace of the slowest
+    recipient and a recipient's backlog stays bounded.
+    """
+
+    def __init__(self, transfer_id, relay_id, sender, recipients, room_name, name, size, window, chunk_size):
+        self.id = transfer_id
+        self.relay_id = relay_id
+        self.relay_prefix = FILE_ID.pack(relay_id)
+        self.sender = sender          # ClientRecord
+        self.recipients = recipients  # ClientRecords
+        self.room_name = room_name
+        self.name = name
+        self.size = size
+        self.received = 0
+        self.credit = 0  # the sender's first grant of window chunks sets it
+        self.backlog_limit = window * chunk_size
+        # Credits are returned from the recipients' writers
+        self.lock = threading.Lock()
+
+    def grant(self, chunks):
+        """Queue a FILE_CREDIT for the sender, 0 chunks tells it to stop"""
+        with self.lock:
+            self.credit += chunks
+        self.sender.outbox.put_bulk(encode_frame(FILE_CREDIT, FILE_CREDIT_GRANT.pack(self.id, chunks)))
+
+    def take_credit(self):
+        with self.lock:
+            self.credit -= 1
+            return self.credit >= 0
+
+    def relay(self, frame_type, data):
+        """Queue a frame for every recipient, dropping those that are gone; False when none is left"""
+        frame = FileFrame(frame_type, data)
+        self.recipients = [client for client in self.recipients if client.outbox.put_bulk(frame)]
+        return bool(self.recipients)
+
+    def relay_chunk(self, data):
+        self.received += len(data)
+        if not self.relay(FILE_CHUNK, self.relay_prefix + data):
+            return False
+        self.return_credit()
+        return True
+
+    def return_credit(self):
+        """Give the sender its chunk back once no recipient has more than the window waiting"""
+        backlogged = [client.outbox for client in self.recipients if client.outbox.bulk_bytes >= self.backlog_limit]
+        if not backlogged:
+            self.grant(1)
+            return
+        waiting = [len(backlogged)]
+
+        def drained():
+            with self.lock:
+                waiting[0] -= 1
+                if waiting[0]:
+                    return
+            self.grant(1)
+
+        for outbox in backlogged:
+            outbox.when_below(self.backlog_limit, drained)
+
+    def finish(self, status):
+        """Tell the recipients the file is complete or cancelled, returns the status they got"""
+        if status == FILE_DONE and self.received != self.size:
+            status = FILE_CANCELLED
+        self.relay(FILE_END, self.relay_prefix + bytes([status]))
+        return status
+
+
+# Longest file name, in UTF-8 bytes, a sender may offer: what most file systems allow
+MAX_FILE_NAME = 255
+
+
+def safe_file_name(name):
+    """The last path component of a name a peer sent, never empty, '.' or '..'"""
+    name = os.path.basename(name.replace('\\', '/')).strip()
+    return name if name not in ('', '.', '..') else 'file'
+
+
+class IncomingFile:
+    """A file arriving from the server, written to disk chunk by chunk.
+
+    Data goes to name.part in directory, renamed to a name that is not taken
+    yet once the file is complete and removed if the transfer is cancelled.
+    Without a directory the data is only counted, so the session stream keeps
+    being decrypted in step, and skipped tells the user why.
+    """
+
+    def __init__(self, directory, room_name, sender, name, size, skipped='not saved'):
+        self.room_name = room_name
+        self.skipped = skipped
+        self.sender = sender
+        self.name = safe_file_name(name)
+        self.size = size
+        self.received = 0
+        self.path = None
+        self.file = None
+        self.complete = False
+        if directory:
+            try:
+                self.open(directory)
+            except OSError as e:
+                # Name too long for this file system, disk full, no permission: skip the file, keep the connection
+                self.skipped = f"not saved, {(e.strerror or str(e)).lower()}"
+
+    def open(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        base, extension = os.path.splitext(self.name)
+        # Leave room for ' (999)' and '.part' within the file system's name limit
+        room = MAX_FILE_NAME - len(' (999).part') - len(extension.encode('utf-8'))
+        if room < 1:
+            base, extension = self.name, ''
+            room = MAX_FILE_NAME - len(' (999).part')
+        base = base.encode('utf-8')[:room].decode('utf-8', 'ignore')
+        for n in range(1000):
+            path = os.path.join(directory, f"{base} ({n}){extension}" if n else base + extension)
+            if os.path.exists(path):
+                continue
+            try:
+                self.file = open(path + '.part', 'xb')
+            except FileExistsError:
+                continue
+            self.path = path
+            return
+
+    def describe(self):
+        note = '' if self.file else f", {self.skipped}"
+        return f"[{self.room_name}] {self.sender} is sending {self.name} ({format_size(self.size)}{note})"
+
+    def write(self, data):
+        self.received += len(data)
+        if self.received > self.size:
+            raise ConnectionError(f"{self.name} is larger than offered")
+        if self.file:
+            self.file.write(data)
+
+    def finish(self, status):
+        """Close the file, keeping it only if it arrived complete; returns the notice to show"""
+        complete = self.complete = status == FILE_DONE and self.received == self.size
+        if self.file:
+            self.file.close()
+            if complete:
+                os.replace(self.path + '.part', self.path)
+            else:
+                os.remove(self.path + '.part')
+        if not complete:
+            return f"[{self.room_name}] {self.sender} cancelled sending {self.name}"
+        if not self.file:
+            return None
+        return f"[{self.room_name}] Received {self.name} from {self.sender}, saved as {self.path}"